@@ -2,6 +2,18 @@ from .src.PhyObjects import (
     MassPoint, 
     Particles, 
     Wall, 
+    Walls, 
     Simulation, 
     Gas
-)
\ No newline at end of file
+)
+from .src.PhyRecorder import Recorder, Trajectory
+from .src.PhyExport import FrameWriter
+from .src.PhyStats import Stats
+from .src.PhyObservables import Observables
+from .src.PhyPlacement import lattice, poisson_disk
+from .src.PhyForces import Forces, QuadTree
+from .src.PhyNeighbours import NeighbourList
+from .src.PhyGrid import Grid
+from .src.PhyParallel import ParallelSimulation
+from .src.PhyEvents import EventDrivenSimulation
+from .src.PhyEnsemble import Ensemble, GasEnsemble
@@ -0,0 +1,324 @@
+'''
+Benchmarks built from the scenes in physim/test (and two with long-range forces). Each scene is built headlessly with a given
+number of particles and stepped a fixed number of times, timing every phase of the step.
+
+    python -m physim.src.PhyBench --scenes gas wave --N 150 2000 --steps 200 --out bench.json
+    python -m physim.src.PhyBench --out new.json --compare bench.json
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from .PhyObjects import Particles, Wall, Gas, Simulation
+from .PhyForces import Forces, QuadTree, direct_field
+from .PhySimFunctions import expand_ranges
+from .PhyPlacement import poisson_disk
+from . import PhyStats
+from .PhyStats import COUNTERS
+
+#The phases of a headless step (nothing is drawn).
+PHASES = tuple(name for name in PhyStats.PHASES if name != 'draw')
+#The largest error of the Barnes-Hut field at theta = 0.5 (see tree_error) that isn't a bug.
+TREE_TOLERANCE = 0.005
+
+def gas_scene(N):
+    '''
+    test/Gas.py: a Gas in a box, with the box and the energy grown with N so the density and
+    the energy per particle stay the same as with the 150 particles of the test.
+    '''
+    grow = np.sqrt(N/150)
+    WIDTH, HEIGHT = int(700*grow), int(600*grow)
+    G = Gas([WIDTH/2, HEIGHT/2], N, 1, 1*10**7 * N/150, WIDTH, HEIGHT)
+    return Simulation(G, size = (WIDTH, HEIGHT), name = 'Gas', headless = True)
+
+def block_scene(N):
+    '''
+    test/Block.py: a block of particles moving together, four times wider than tall.
+    '''
+    SCALE = 10
+    cols = max(1, int(round(np.sqrt(4*N))))
+    rows = int(np.ceil(N/cols))
+    i, j = np.divmod(np.arange(N), rows)
+    r = np.column_stack((SCALE*(2*i+1), 3*SCALE*(j+1)))
+    Block = Particles.from_arrays(r, [10*SCALE, 5*SCALE], 1, radius = 0.5*SCALE)
+    size = (max(600, SCALE*(2*cols+2)), max(600, 3*SCALE*(rows+1) + SCALE))
+    return Simulation(Block, size = size, name = 'Block', headless = True)
+
+def wave_scene(N):
+    '''
+    test/Wave.py: a lattice at rest hit by a column of moving particles on its left side.
+    '''
+    SCALE = 30
+    h = max(1, int(round(np.sqrt(N))))
+    w = int(np.ceil(N/h))
+    i, j = np.divmod(np.arange(N), h)
+    r = np.column_stack((SCALE*(2*i+1), 3*SCALE*(j+1)))
+    v = np.where((i == 0)[:, None], [10*SCALE, 0], [0, 0])
+    Medium = Particles.from_arrays(r, v, 1, radius = 0.5*SCALE)
+    size = (SCALE*(2*w+1), 3*SCALE*(h+1))
+    return Simulation(Medium, size = size, name = 'Wave', headless = True)
+
+def collision_scene(N):
+    '''
+    test/Collision.py: heavy and light particles of two sizes bouncing between interior walls.
+    Besides the two walls of the test, there is one small wall every 40 particles.
+    '''
+    SCALE = 10
+    grow = max(1, np.sqrt(N/30))
+    WIDTH, HEIGHT = int(600*grow), int(600*grow)
+    walls = [Wall([WIDTH/2, HEIGHT/2], WIDTH, SCALE), Wall([2*WIDTH/3, 3*HEIGHT/4], 2*SCALE, HEIGHT/4)]
+    for k in range(N//40):
+        walls.append(Wall([random.uniform(0, WIDTH), random.uniform(0, HEIGHT)], 2*SCALE, 6*SCALE))
+
+    big = np.random.rand(N) < 0.5
+    P = Particles.from_arrays(np.random.rand(N, 2) * [WIDTH, HEIGHT], 10*SCALE*np.random.randn(N, 2), np.where(big, 2, 1),
+                              radius = np.where(big, 2*SCALE, 1*SCALE))
+    return Simulation(P, walls = walls, size = (WIDTH, HEIGHT), name = 'Collision', headless = True)
+
+def plasma_scene(N):
+    '''
+    Equal numbers of positive and negative charges with thermal velocities, under the Coulomb
+    force computed with the Barnes-Hut tree.
+    '''
+    L = int(20*np.sqrt(N)) + 100
+    r = poisson_disk(N, [L/2, L/2], L - 20, L - 20, 3)
+    q = np.where(np.arange(N) % 2, 1, -1)
+    P = Particles.from_arrays(r, 100*np.random.randn(N, 2), 1, q = q, radius = 3,
+                              color = np.where((q > 0)[:, None], (200, 60, 60), (60, 60, 200)))
+    return Simulation(P, size = (L, L), name = 'Plasma', headless = True, forces = Forces(k = 10**5, softening = 3))
+
+def nbody_scene(N):
+    '''
+    A cloud of particles at rest collapsing under its own gravity.
+    '''
+    L = int(20*np.sqrt(N)) + 100
+    r = poisson_disk(N, [L/2, L/2], L/2, L/2, 2)
+    P = Particles.from_arrays(r, 0, 1, radius = 2)
+    return Simulation(P, size = (L, L), name = 'N-body', headless = True, forces = Forces(G = 100, softening = 5))
+
+def mixture_scene(N):
+    '''
+    A few large disks (one in a hundred, ten times wider) among many small ones, in a gas. With
+    a single grid, the cells sized for the large disks would hold dozens of small ones each.
+    '''
+    SCALE = 3
+    L = int(12*SCALE*np.sqrt(N)) + 100
+    big = np.arange(N) % 100 == 0
+    P = Particles.from_arrays(np.random.rand(N, 2) * L, 10*SCALE*np.random.randn(N, 2), np.where(big, 100, 1),
+                              radius = np.where(big, 10*SCALE, SCALE),
+                              color = np.where(big[:, None], (200, 120, 40), (0, 180, 200)))
+    return Simulation(P, size = (L, L), name = 'Mixture', headless = True)
+
+SCENES = {
+    'gas': gas_scene,
+    'block': block_scene,
+    'wave': wave_scene,
+    'collision': collision_scene,
+    'mixture': mixture_scene,
+    'plasma': plasma_scene,
+    'nbody': nbody_scene
+}
+
+def bench(scene, N, steps = 100, naive = False, warmup = 5, seed = 0):
+    '''
+    Builds a scene and times steps time steps of it, phase by phase.
+        Inputs:
+                scene (str): One of the names in SCENES.
+                N (int): The number of particles.
+            Optional:
+                steps (int): The number of timed steps. (100 by default)
+                naive (boolean): Use Simulation.naive_particles_collisions instead of the spatial hash.
+                warmup (int): Steps taken before timing. (5 by default)
+                seed (int): The seed for the random scenes.
+        Outputs:
+                result (dict): The steps per second, the seconds per step of each phase (from
+                    Simulation.stats) and the candidate pairs, collisions and wall contacts per step.
+    '''
+    np.random.seed(seed)
+    random.seed(seed)
+    sim = SCENES[scene](N)
+    sim.step(warmup, naive = naive)
+
+    stats = sim.stats
+    stats.reset(window = steps)
+    start = time.perf_counter()
+    sim.step(steps, naive = naive)
+    total = time.perf_counter() - start
+
+    return {
+        'scene': scene,
+        'N': sim.P.N,
+        'naive': naive,
+        'steps': steps,
+        'seconds': total,
+        'steps_per_sec': steps/total,
+        'phases': {name: stats.totals[name]/steps for name in PHASES},
+        'counts': {name: stats.totals[name]/steps for name in COUNTERS}
+    }
+
+def import_time(repeat = 5):
+    '''
+    Measures `import physim` in fresh interpreters.
+        Outputs:
+                seconds (float): The best time of repeat imports.
+                pygame (boolean): If importing physim also imported pygame (it shouldn't).
+    '''
+    code = ('import sys, time; t = time.perf_counter(); import physim; '
+            'print(time.perf_counter() - t, "pygame" in sys.modules)')
+    #The folder that contains the physim package, so we time this copy of it.
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+
+    best = np.inf
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, env = env, check = True)
+        seconds, pygame = out.stdout.split()
+        best = min(best, float(seconds))
+    return best, pygame == 'True'
+
+def tree_error(N = 2000, theta = 0.5, seed = 0):
+    '''
+    Checks the Barnes-Hut tree on a clustered cloud (a tight clump and a wide one), where the
+    leaves of the tree are at very different depths: the field against the exact sum, and the
+    boxes of the buckets against the particles in them (a wrong box barely changes the field,
+    but it breaks the opening test).
+        Outputs:
+                error (float): The root mean square error of the field, relative to the root mean
+                    square field.
+                wrong (int): The number of buckets whose box isn't the one around their particles.
+    '''
+    rng = np.random.default_rng(seed)
+    r = np.concatenate((rng.normal(0, 1, (N//2, 2)), rng.normal(50, 20, (N - N//2, 2))))
+    w = rng.uniform(0.5, 2, N)
+    tree = QuadTree(r)
+    E, _ = tree.field(r, w, theta, potential = False)
+    exact, _ = direct_field(r, w)
+    error = float(np.sqrt(((E - exact)**2).sum() / (exact**2).sum()))
+
+    bucket, k = expand_ranges(tree.start[tree.buckets], tree.count[tree.buckets])
+    lo = np.full((len(tree.buckets), 2), np.inf)
+    hi = np.full((len(tree.buckets), 2), -np.inf)
+    np.minimum.at(lo, bucket, r[tree.order[k]])
+    np.maximum.at(hi, bucket, r[tree.order[k]])
+    wrong = int(np.sum(np.any((lo != tree.lo) | (hi != tree.hi), axis = 1)))
+    return error, wrong
+
+def run(scenes = tuple(SCENES), sizes = (150,), steps = 100, naive_max = 300, seed = 0):
+    '''
+    Runs bench for every scene and size, with the spatial hash and also with the naive
+    collisions when N is at most naive_max (they are O(N^2) Python loops).
+    '''
+    seconds, pygame = import_time()
+    error, wrong = tree_error()
+    results = []
+    for scene in scenes:
+        for N in sizes:
+            results.append(bench(scene, N, steps = steps, seed = seed))
+            if N <= naive_max:
+                results.append(bench(scene, N, steps = steps, naive = True, seed = seed))
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'import_seconds': seconds,
+            'import_pygame': pygame,
+            'tree_error': error,
+            'tree_wrong_boxes': wrong
+        },
+        'results': results
+    }
+
+def _key(result):
+    return (result['scene'], result['N'], result['naive'])
+
+def compare(new, old, tolerance = 0.1):
+    '''
+    Compares two outputs of run and lists the runs whose steps per second dropped more than
+    the tolerance (a fraction), and also checks the time of `import physim`.
+        Outputs:
+                rows (list of tuple): (scene, N, naive, old steps/s, new steps/s, ratio) for every common run,
+                    and ('import physim', 0, False, old seconds, new seconds, speedup) for the startup.
+                regressions (list of tuple): The rows that got slower than the tolerance.
+    '''
+    previous = {_key(r): r for r in old['results']}
+    rows = []
+    for r in new['results']:
+        if _key(r) in previous:
+            before = previous[_key(r)]['steps_per_sec']
+            rows.append(_key(r) + (before, r['steps_per_sec'], r['steps_per_sec']/before))
+    regressions = [row for row in rows if row[-1] < 1 - tolerance]
+
+    #Startup time: a few milliseconds of noise are not a regression.
+    before, after = old['meta'].get('import_seconds'), new['meta'].get('import_seconds')
+    if (before is not None) and (after is not None):
+        row = ('import physim', 0, False, before, after, before/after)
+        rows.append(row)
+        if after > before*(1 + tolerance) + 0.01:
+            regressions.append(row)
+    if new['meta'].get('import_pygame'):
+        regressions.append(('import physim', 0, False, 0, 0, 0))
+    if (new['meta'].get('tree_error', 0) > TREE_TOLERANCE) or new['meta'].get('tree_wrong_boxes'):
+        regressions.append(('tree error', 0, False, 0, new['meta']['tree_error'], 0))
+    return rows, regressions
+
+def report(output, file = sys.stdout):
+    '''
+    Prints the results of run as a table.
+    '''
+    meta = output['meta']
+    print('import physim: {:.1f} ms{}'.format(1000*meta['import_seconds'], ' (imports pygame!)' if meta['import_pygame'] else ''), file = file)
+    print('Barnes-Hut error at theta = 0.5: {:.2e}, wrong bucket boxes: {}'.format(meta['tree_error'], meta['tree_wrong_boxes']), file = file)
+    print('{:<10} {:>7} {:>6} {:>10}'.format('scene', 'N', 'naive', 'steps/s') +
+          ''.join(' {:>12}'.format(name + ' ms') for name in PHASES), file = file)
+    for r in output['results']:
+        print('{:<10} {:>7} {:>6} {:>10.1f}'.format(r['scene'], r['N'], str(r['naive']), r['steps_per_sec']) +
+              ''.join(' {:>12.3f}'.format(1000*r['phases'][name]) for name in PHASES), file = file)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the physim test scenes.')
+    parser.add_argument('--scenes', nargs = '+', choices = tuple(SCENES), default = list(SCENES))
+    parser.add_argument('--N', nargs = '+', type = int, default = [150, 1000])
+    parser.add_argument('--steps', type = int, default = 100)
+    parser.add_argument('--naive-max', type = int, default = 300, help = 'largest N benchmarked with naive=True')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--out', help = 'write the results to this JSON file')
+    parser.add_argument('--compare', help = 'a previous JSON file to compare against')
+    parser.add_argument('--tolerance', type = float, default = 0.1, help = 'slowdown that counts as a regression')
+    args = parser.parse_args(argv)
+
+    output = run(args.scenes, args.N, steps = args.steps, naive_max = args.naive_max, seed = args.seed)
+    report(output)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            rows, regressions = compare(output, json.load(f), args.tolerance)
+        for scene, N, naive, before, after, ratio in rows:
+            if scene == 'import physim':
+                print('import physim: {:.1f} ms -> {:.1f} ms'.format(1000*before, 1000*after))
+                continue
+            if scene == 'tree error':
+                continue
+            print('{:<10} {:>7} {:>6} {:>10.1f} -> {:>10.1f} ({:+.1%})'.format(scene, N, str(naive), before, after, ratio - 1))
+        if regressions:
+            print(str(len(regressions)) + ' regression(s)')
+            return 1
+    if (output['meta']['tree_error'] > TREE_TOLERANCE) or output['meta']['tree_wrong_boxes']:
+        print('the Barnes-Hut field is wrong')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
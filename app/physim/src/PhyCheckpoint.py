@@ -0,0 +1,148 @@
+import os
+import random
+import threading
+
+import numpy as np
+
+#A checkpoint is a single record: this header, then every particle array, the walls, the
+#borders and the states of the random generators, each one at a fixed, aligned offset, so the
+#whole file can be memory-mapped back in as a numpy record.
+MAGIC = b'PHYSIMCK'
+VERSION = 1
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('walls', '<u4'),
+    ('borders', '<u4'),
+    ('N', '<u8'),
+    ('steps', '<i8'),
+    ('t', '<f8'),
+    ('dt', '<f8'),
+    #numpy's global generator (MT19937): the position and the cached gaussian.
+    ('np_pos', '<i8'),
+    ('np_has_gauss', '<i8'),
+    ('np_gauss', '<f8'),
+    #Python's random module: its version and the next gaussian (if any).
+    ('py_version', '<i8'),
+    ('py_has_gauss', '<i8'),
+    ('py_gauss', '<f8')
+])
+
+def checkpoint_dtype(N, walls, borders):
+    '''
+    The binary layout of a checkpoint with N particles and the given numbers of walls and borders.
+    Each wall is (x, y, width, height, impulse x, impulse y).
+    '''
+    return np.dtype([
+        ('header', HEADER),
+        ('r', '<f8', (N, 2)),
+        ('v', '<f8', (N, 2)),
+        ('a', '<f8', (N, 2)),
+        ('m', '<f8', (N,)),
+        ('q', '<f8', (N,)),
+        ('radius', '<f8', (N,)),
+        ('group', '<i8', (N,)),
+        ('walls', '<f8', (walls, 6)),
+        ('borders', '<f8', (borders, 6)),
+        ('np_keys', '<u4', (624,)),
+        ('py_state', '<u4', (625,)),
+        ('color', 'u1', (N, 3))
+    ], align = True)
+
+def _walls(W, impulse):
+    return np.array([(w.r[0], w.r[1], w.width, w.height, i[0], i[1]) for w, i in zip(W, impulse)], dtype = float).reshape(-1, 6)
+
+def snapshot(sim):
+    '''
+    A copy of the whole state of the simulation, as a checkpoint record in memory.
+    '''
+    P = sim.P
+    nw, nb = len(sim.walls), len(sim.borders)
+    state = np.zeros((), dtype = checkpoint_dtype(P.N, nw, nb))
+
+    _, keys, pos, has_gauss, gauss = np.random.get_state()
+    version, py_state, py_gauss = random.getstate()
+    state['header'] = (MAGIC, VERSION, nw, nb, P.N, sim.steps, sim.t, sim.dt, pos, has_gauss, gauss,
+                       version, py_gauss is not None, py_gauss or 0)
+    state['np_keys'] = keys
+    state['py_state'] = py_state
+
+    for name, _, _ in P._FIELDS:
+        state[name[1:]] = getattr(P, name)[:P.N]
+    impulse = sim.W.impulse
+    state['walls'] = _walls(sim.walls, impulse[:nw])
+    state['borders'] = _walls(sim.borders, impulse[nw:])
+    return state
+
+def write(state, path):
+    '''
+    Writes a checkpoint record to path. It's written to a temporary file first and then
+    renamed, so a crash never leaves a half-written checkpoint at path.
+    '''
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(state.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def save(sim, path, background = False):
+    '''
+    Saves a checkpoint of the simulation. With background, only the snapshot is taken now and
+    the file is written by a thread, which is returned.
+    '''
+    state = snapshot(sim)
+    if not background:
+        write(state, path)
+        return None
+    thread = threading.Thread(target = write, args = (state, path), daemon = True)
+    thread.start()
+    return thread
+
+def load(path):
+    '''
+    Memory-maps a checkpoint file (copy-on-write: the arrays can be changed without touching
+    the file) and returns it as a record.
+    '''
+    header = np.fromfile(path, dtype = HEADER, count = 1)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError(path + ' is not a physim checkpoint')
+    if header['version'] != VERSION:
+        raise ValueError('unsupported checkpoint version ' + str(header['version']))
+    dtype = checkpoint_dtype(int(header['N']), int(header['walls']), int(header['borders']))
+    return np.memmap(path, dtype = dtype, mode = 'c', shape = ())
+
+def restore(sim, path):
+    '''
+    Puts the state saved in path back into the simulation. The particle arrays are the
+    memory-mapped arrays of the file, so nothing is read until it's used.
+    '''
+    from .PhyObjects import Wall
+
+    state = load(path)
+    header = state['header']
+    P = sim.P
+    N = int(header['N'])
+    for name, _, _ in P._FIELDS:
+        setattr(P, name, state[name[1:]])
+    P.N = N
+
+    #With the same walls we keep sim.W (the observables hold on to it); otherwise they're packed again.
+    same = all(np.array_equal(state[name][:, :4], _walls(W, np.zeros((len(W), 2)))[:, :4])
+               for name, W in (('walls', sim.walls), ('borders', sim.borders)))
+    if not same:
+        sim.walls = [Wall(w[:2], w[2], w[3]) for w in state['walls'].tolist()]
+        sim.borders = [Wall(w[:2], w[2], w[3]) for w in state['borders'].tolist()]
+        sim.pack_walls()
+    sim.W.impulse[:] = np.concatenate((state['walls'][:, 4:], state['borders'][:, 4:]))
+    sim.t = float(header['t'])
+    sim.steps = int(header['steps'])
+    sim.dt = float(header['dt'])
+    if sim.observables is not None:
+        sim.observables.rebind()
+    sim.stats.seen = None
+
+    np.random.set_state(('MT19937', np.array(state['np_keys']), int(header['np_pos']),
+                         int(header['np_has_gauss']), float(header['np_gauss'])))
+    random.setstate((int(header['py_version']), tuple(int(k) for k in state['py_state']),
+                     float(header['py_gauss']) if header['py_has_gauss'] else None))
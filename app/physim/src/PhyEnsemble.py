@@ -0,0 +1,125 @@
+import numpy as np
+
+from .PhyObjects import Particles
+from .PhyPlacement import poisson_disk
+
+class Ensemble(Particles):
+    '''
+    R independent replicas of a system of n particles, stored together as one Particles with
+    N = R*n particles where each replica is a group (particles in different groups never
+    collide). The arrays are ordered replica by replica, so stacked() turns any of them into
+    an (R, n, ...) view, and a single Simulation steps all the replicas at once. All the
+    replicas share the same box and walls.
+    '''
+    def __init__(self, *replicas):
+        '''
+            Inputs:
+                    *replicas (*args of physim.Particles): The replicas, all with the same number of particles.
+        '''
+        Particles.__init__(self)
+        self.R = len(replicas)
+        self.n = replicas[0].N if replicas else 0
+        for k, rep in enumerate(replicas):
+            if rep.N != self.n:
+                raise ValueError('all the replicas must have the same number of particles')
+            self._extend(rep.positions, rep.velocities, rep.masses, rep.accelerations, rep.charges,
+                         rep.radii, rep.colors, group = k)
+
+    def stacked(self, array):
+        '''
+        The (R, n, ...) view of one of the particle arrays, like stacked(self.velocities).
+        '''
+        return array.reshape((self.R, self.n) + array.shape[1:])
+
+    def speeds(self):
+        '''
+        The speed of every particle, as an (R, n) array.
+        '''
+        return np.linalg.norm(self.stacked(self.velocities), axis = 2)
+
+    def kinetic_energy(self):
+        '''
+        The kinetic energy of each replica, as an (R,) array.
+        '''
+        v = self.stacked(self.velocities)
+        return 0.5 * np.einsum('rn,rnk,rnk->r', self.stacked(self.masses), v, v)
+
+    def momentum(self):
+        '''
+        The total momentum of each replica, as an (R, 2) array.
+        '''
+        return np.einsum('rn,rnk->rk', self.stacked(self.masses), self.stacked(self.velocities))
+
+    def temperature(self):
+        '''
+        The temperature of each replica (with k_B = 1), from the equipartition of the kinetic
+        energy in two dimensions: E = n*T.
+        '''
+        return self.kinetic_energy() / self.n
+
+    def speed_histogram(self, bins = 30, range = None):
+        '''
+        The histogram of the speeds of each replica.
+            Inputs:
+                    bins (int): The number of bins. (30 by default)
+                    range (tuple of float): The lowest and highest speeds. (0 and the highest speed by default)
+            Outputs:
+                    counts (np.ndarray of int): An (R, bins) array with the counts of each replica.
+                    edges (np.ndarray of float): The bins + 1 edges of the bins.
+        '''
+        s = self.speeds()
+        if range is None:
+            range = (0, s.max() if s.size else 1)
+        edges = np.linspace(range[0], range[1], bins + 1)
+        #The last bin includes its right edge, as in np.histogram.
+        idx = np.searchsorted(edges, s, side = 'right') - 1
+        idx[s == edges[-1]] = bins - 1
+        valid = (0 <= idx) & (idx < bins)
+        flat = (np.arange(self.R)[:, None] * bins + idx)[valid]
+        counts = np.bincount(flat, minlength = self.R * bins).reshape(self.R, bins)
+        return counts, edges
+
+    @staticmethod
+    def maxwell_boltzmann(v, T, m = 1):
+        '''
+        The Maxwell-Boltzmann distribution of the speeds in two dimensions (with k_B = 1),
+        to compare with speed_histogram.
+        '''
+        return m * v / T * np.exp(-m * v**2 / (2*T))
+
+class GasEnsemble(Ensemble):
+    '''
+    R replicas of a physim.Gas, each one with its own random positions, velocities and colors.
+    '''
+    def __init__(self, R, r_0, N, m, energy, width, height, radius = 10, SCALE = 10, seed = None):
+        '''
+            Inputs:
+                    R (int): The number of replicas.
+                    r_0, N, m, energy, width, height, radius, SCALE: As in physim.Gas, for each replica.
+                Optional:
+                    seed (int): The seed of the random generator, to build the same ensemble again.
+        '''
+        Ensemble.__init__(self)
+        self.R = R
+        self.n = N
+        self.Rcm = r_0
+        self.m = m
+        self.energy = energy
+        self.width = width
+        self.height = height
+        self.radius = radius
+        self.SCALE = SCALE
+
+        rng = np.random.default_rng(seed)
+        energies = rng.random((R, N))
+        energies = energy * energies/energies.sum(axis = 1, keepdims = True)
+        vel = np.sqrt(2*energies)
+        theta = 2* np.pi * rng.random((R, N))
+        v = np.stack((vel * np.cos(theta), vel * np.sin(theta)), axis = 2)
+
+        #Each replica gets its own positions without overlaps.
+        r = np.stack([poisson_disk(N, r_0, width, height, radius, rng = rng) for _ in range(R)])
+        color = 10*np.stack((rng.integers(0, 11, (R, N)), rng.integers(10, 26, (R, N)), rng.integers(20, 26, (R, N))), axis = 2)
+
+        self._extend(r.reshape(-1, 2), v.reshape(-1, 2), m, radius = radius, color = color.reshape(-1, 3),
+                     group = np.repeat(np.arange(R), N))
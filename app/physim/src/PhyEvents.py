@@ -0,0 +1,349 @@
+import heapq
+from itertools import count
+
+import numpy as np
+
+from .PhySimFunctions import elastic_collision
+
+#The kinds of events in the queue.
+_PAIR = 0
+_WALL = 1
+_CELL = 2
+
+#The default side of the cells, in diameters, unless that gives more than CELL_PARTICLES
+#particles per cell on average.
+CELL_DIAMETERS = 8
+CELL_PARTICLES = 4
+
+class EventDrivenSimulation:
+    '''
+    An event-driven engine for hard disks. Between events every particle flies in a straight
+    line, so instead of taking small time steps we compute the exact time of the next
+    disk-disk and disk-wall collisions and jump straight to it. The events are kept in a
+    priority queue, only the next one of each particle; when a particle changes its course,
+    its old event is not removed but becomes stale, and it's skipped when it comes out of the
+    queue (if it was the next event of its partner, the partner predicts its next one again).
+
+    To avoid predicting every pair, the particles are kept in a grid with cells of at least one
+    diameter: a particle can only hit the particles in its own and the 8 neighbouring cells,
+    and crossing into a new cell is an event too. The cells are rows of an array with the
+    particles in them, so the neighbours are found with a single lookup.
+
+    The collisions use the same rules as the rest of physim: the elastic formula of
+    MassPoint.particle_collision, and the walls of MassPoint.wall_collision (which treat the
+    particle as its bounding square).
+    '''
+    def __init__(self, sim, cell = None):
+        '''
+            Inputs:
+                    sim (physim.Simulation): The simulation to run. Its particles must have no
+                        acceleration and it can't have forces, and while the engine is attached its arrays are only
+                        written at the end of each time step.
+                Optional:
+                    cell (float): The side of the grid cells, at least one diameter. Bigger cells
+                        mean fewer cell crossings but more neighbours to check. (By default,
+                        CELL_DIAMETERS diameters, or the side that gives about CELL_PARTICLES
+                        particles per cell if that's smaller)
+        '''
+        P = sim.P
+        if sim.forces is not None:
+            raise ValueError('the event-driven engine needs free flight: sim.forces must be None')
+        if np.any(P.accelerations != 0):
+            raise ValueError('the event-driven engine needs free flight: all the accelerations must be 0')
+
+        self.sim = sim
+        self.P = P
+        self.N = P.N
+        #Each particle's position is stored at its own time t0, the last time it was updated.
+        self.now = float(sim.t)
+        self.r = P.positions.copy()
+        self.v = P.velocities.copy()
+        self.t0 = np.full(self.N, self.now, dtype = float)
+        self.m = P.masses.copy()
+        self.radius = P.radii.copy()
+        self.group = P.groups.copy()
+        #Whether there are several groups (that don't collide with each other).
+        self.groups = self.N and (self.group.min() != self.group.max())
+        #How many times each particle changed its course; events remember these counts.
+        self.counts = np.zeros(self.N, dtype = np.int64)
+
+        self.lo = sim.W.lo
+        self.hi = sim.W.hi
+        self.centers = sim.W.centers
+        self.half = sim.W.half
+        self.impulse = sim.W.impulse
+
+        diameter = 2*self.radius.max() if self.N else 1
+        if cell is None:
+            cell = min(CELL_DIAMETERS*diameter, np.sqrt(CELL_PARTICLES*sim.size[0]*sim.size[1] / max(self.N, 1)))
+        self.L = max(cell, diameter)
+        self.shape = np.maximum(np.ceil(np.asarray(sim.size) / self.L).astype(np.int64), 1)
+        self.cell = np.clip(np.floor(self.r / self.L).astype(np.int64), 0, self.shape - 1)
+        #The particles of each cell are the first fill[key] entries of the row table[key] (and
+        #slot[i] is the place of i in its row). The grid has a border of empty cells, so the
+        #8 neighbours of every cell are in the table.
+        rows = self.shape[1] + 2
+        self.keys = (self.cell[:, 0] + 1)*rows + self.cell[:, 1] + 1
+        self.around = np.array([dx*rows + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+        self.fill = np.bincount(self.keys, minlength = (self.shape[0] + 2)*rows)
+        self.table = np.full((len(self.fill), max(4, int(self.fill.max(initial = 0)))), -1, dtype = np.int64)
+        order = np.argsort(self.keys, kind = 'stable')
+        first = np.cumsum(self.fill) - self.fill
+        self.slot = np.empty(self.N, dtype = np.int64)
+        self.slot[order] = np.arange(self.N) - first[self.keys[order]]
+        self.table[self.keys, self.slot] = np.arange(self.N)
+
+        #Some counters, to see how the engine is doing.
+        self.events = 0
+        self.stale = 0
+        self.collisions = 0
+        self.wall_hits = 0
+
+        self.queue = []
+        self.seq = count()
+        for i in range(self.N):
+            self.predict(i)
+        sim.engine = self
+
+    def position(self, i, t):
+        return self.r[i] + self.v[i] * (t - self.t0[i])
+
+    def move(self, i, t):
+        '''
+        Brings the particle i to the time t.
+        '''
+        self.r[i] += self.v[i] * (t - self.t0[i])
+        self.t0[i] = t
+
+    def push(self, t, kind, i, j):
+        cj = self.counts[j] if kind == _PAIR else 0
+        heapq.heappush(self.queue, (t, next(self.seq), kind, i, j, self.counts[i], cj))
+
+    def crossing(self, i):
+        '''
+        The time at which the particle i leaves its cell, and the axis and direction in which it leaves.
+        '''
+        best = (np.inf, 0, 0)
+        cell, v, r = self.cell[i].tolist(), self.v[i].tolist(), self.r[i].tolist()
+        for axis in (0, 1):
+            c = cell[axis]
+            #The cells on the edges of the grid reach to infinity.
+            if (v[axis] > 0) and (c < self.shape[axis] - 1):
+                t = ((c + 1)*self.L - r[axis]) / v[axis]
+                best = min(best, (t, axis, 1))
+            elif (v[axis] < 0) and (c > 0):
+                t = (c*self.L - r[axis]) / v[axis]
+                best = min(best, (t, axis, -1))
+        return best
+
+    def predict(self, i):
+        '''
+        Puts in the queue the next event of the particle i, which must be at the current time.
+        '''
+        t = self.now
+        exit, axis, direction = self.crossing(i)
+        exit = max(exit, 0)
+        best = (exit, _CELL, 2*axis + (direction > 0))
+
+        #Other particles: the time at which |dr + dv*s| reaches the sum of the radii.
+        near = self.table[self.keys[i] + self.around].ravel()
+        near = near[(near >= 0) & (near != i)]
+        if self.groups:
+            near = near[self.group[near] == self.group[i]]
+        if len(near):
+            v = self.v[near]
+            dr = self.r[near] + v * (t - self.t0[near])[:, None] - self.r[i]
+            dv = v - self.v[i]
+            b = np.einsum('ij,ij->i', dr, dv)
+            dvdv = np.einsum('ij,ij->i', dv, dv)
+            sigma = self.radius[near] + self.radius[i]
+            c = np.einsum('ij,ij->i', dr, dr) - sigma*sigma
+            disc = b*b - dvdv*c
+            #Only the ones approaching (so dv is not 0) can be hit.
+            k = np.flatnonzero((b < 0) & (disc >= 0))
+            if len(k):
+                s = np.where(c[k] < 0, 0, -(b[k] + np.sqrt(disc[k])) / dvdv[k])
+                first = int(np.argmin(s))
+                #Events after leaving the cell will be predicted again from the new cell.
+                if s[first] <= best[0]:
+                    best = (float(s[first]), _PAIR, int(near[k[first]]))
+
+        #Walls: the square around the particle enters the wall when it overlaps on both axes.
+        if len(self.lo):
+            w = self.wall_time(i)
+            if (w is not None) and (w[0] < best[0]):
+                best = (w[0], _WALL, w[1])
+
+        if best[0] < np.inf:
+            self.push(t + best[0], best[1], i, best[2])
+
+    def wall_time(self, i):
+        '''
+        The time to the first wall hit by the particle i and the index of that wall, or None.
+        '''
+        r = self.r[i]
+        v = self.v[i]
+        R = self.radius[i]
+        near = r - R - self.hi
+        far = r + R - self.lo
+        #Already inside a wall (after numerical errors, more than a tiny bit): hit it right now.
+        overlap = np.minimum(far, -near).min(axis = 1)
+        inside = overlap > 1e-9 * self.L
+        if inside.any():
+            return 0, int(np.argmax(inside))
+
+        if v[0] and v[1]:
+            #The times at which each side is crossed; the first one is where it enters.
+            a, b = far / -v, near / -v
+            enter, leave = np.minimum(a, b), np.maximum(a, b)
+        else:
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                enter = np.where(v > 0, -far / v, np.where(v < 0, -near / v, np.where((far > 0) & (near < 0), -np.inf, np.inf)))
+                leave = np.where(v > 0, -near / v, np.where(v < 0, -far / v, np.where((far > 0) & (near < 0), np.inf, -np.inf)))
+        start = enter.max(axis = 1)
+        end = leave.min(axis = 1)
+        hits = (start >= 0) & (start < end)
+        if not hits.any():
+            return None
+        k = int(np.argmin(np.where(hits, start, np.inf)))
+        return start[k], k
+
+    def wall_collision(self, i, k):
+        '''
+        The particle i bounces off the wall k, with the rule of MassPoint.wall_collision. The
+        momentum it gives to the wall is added to Walls.impulse, as in Walls.collide.
+        '''
+        R = self.radius[i]
+        overlap = np.minimum(self.r[i] + R - self.lo[k], self.hi[k] - (self.r[i] - R))
+        for axis, bounce in ((1, overlap[0] >= overlap[1]), (0, overlap[0] <= overlap[1])):
+            if bounce:
+                d = -1 if self.r[i, axis] < self.centers[k, axis] else 1
+                self.r[i, axis] = self.centers[k, axis] + d*(self.half[k, axis] + R)
+                self.impulse[k, axis] += 2*self.m[i]*abs(self.v[i, axis])
+                self.v[i, axis] = -self.v[i, axis]
+
+    def separate(self, i, j):
+        '''
+        Two particles that overlap (they can only start that way) are placed side by side
+        around their midpoint, as in MassPoint.particle_collision; otherwise they would keep 
+        colliding at the same instant.
+        '''
+        d = self.r[j] - self.r[i]
+        d_len = np.sqrt(np.dot(d, d))
+        sigma = self.radius[i] + self.radius[j]
+        if d_len >= sigma * (1 - 1e-9):
+            return
+        if d_len == 0:
+            theta = 2* np.pi * np.random.rand()
+            d_unit = np.array([np.cos(theta), np.sin(theta)])
+        else:
+            d_unit = d/d_len
+        midpoint = d*(1/2) + self.r[i]
+        self.r[i] = midpoint - d_unit*self.radius[i]
+        self.r[j] = midpoint + d_unit*self.radius[j]
+        self.recell(i)
+        self.recell(j)
+
+    def recell(self, i):
+        '''
+        Moves the particle i to the cell of its position, after it was placed somewhere else.
+        '''
+        cell = np.clip(np.floor(self.r[i] / self.L).astype(np.int64), 0, self.shape - 1)
+        if np.any(cell != self.cell[i]):
+            self.cell[i] = cell
+            self.rekey(i)
+
+    def rekey(self, i):
+        '''
+        Moves the particle i to the row of the table of its cell, self.cell[i].
+        '''
+        #Out of its old row: the last particle of the row takes its place.
+        key = self.keys[i]
+        last = self.fill[key] - 1
+        k = self.table[key, last]
+        self.table[key, self.slot[i]] = k
+        self.slot[k] = self.slot[i]
+        self.table[key, last] = -1
+        self.fill[key] = last
+
+        key = (self.cell[i, 0] + 1)*(self.shape[1] + 2) + self.cell[i, 1] + 1
+        if self.fill[key] == self.table.shape[1]:
+            self.table = np.hstack((self.table, np.full(self.table.shape, -1, dtype = np.int64)))
+        self.keys[i] = key
+        self.slot[i] = self.fill[key]
+        self.table[key, self.fill[key]] = i
+        self.fill[key] += 1
+
+    def advance(self, T):
+        '''
+        Processes all the events up to the time T and moves every particle to T.
+        '''
+        queue = self.queue
+        while queue and queue[0][0] <= T:
+            t, _, kind, i, j, ci, cj = heapq.heappop(queue)
+            if self.counts[i] != ci:
+                self.stale += 1
+                continue
+            if kind == _PAIR and self.counts[j] != cj:
+                #The partner changed its course first: this was the next event of i, so we
+                #look for the new one.
+                self.stale += 1
+                self.now = t
+                self.move(i, t)
+                self.predict(i)
+                continue
+
+            self.events += 1
+            self.now = t
+            self.move(i, t)
+            self.counts[i] += 1
+
+            if kind == _PAIR:
+                self.move(j, t)
+                self.counts[j] += 1
+                self.separate(i, j)
+                self.v[i], self.v[j] = elastic_collision(self.v[i], self.v[j], self.m[i], self.m[j])
+                self.collisions += 1
+                self.predict(i)
+                self.predict(j)
+
+            elif kind == _WALL:
+                self.wall_collision(i, j)
+                self.wall_hits += 1
+                self.recell(i)
+                self.predict(i)
+
+            else:
+                axis, direction = divmod(j, 2)
+                self.cell[i, axis] += 1 if direction else -1
+                self.rekey(i)
+                self.predict(i)
+
+        self.now = T
+        self.r += self.v * (T - self.t0)[:, None]
+        self.t0[:] = T
+        self.P.positions = self.r
+        self.P.velocities = self.v
+
+    def step(self, n = 1):
+        '''
+        Advances the simulation n time steps of Simulation.dt; the events inside a time step
+        happen at their exact times.
+        '''
+        sim = self.sim
+        for _ in range(n):
+            self.advance(self.now + sim.dt)
+            sim.t = self.now
+            sim.steps += 1
+            if sim.stats.callbacks:
+                sim.stats.notify(sim)
+            for output in (sim.recorder, sim.exporter):
+                if (output is not None) and (sim.steps % output.every == 0):
+                    output.write(sim.P, sim.steps, sim.t)
+
+    def close(self):
+        '''
+        Detaches the engine, so the simulation goes back to fixed time steps.
+        '''
+        if self.sim.engine is self:
+            self.sim.engine = None
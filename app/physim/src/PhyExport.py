@@ -0,0 +1,159 @@
+'''
+Writing rendered frames to disk without stopping the simulation: the frames (raw RGBX
+buffers, 4 bytes per pixel with the last one ignored, which pygame copies out of a Surface
+fastest) go through a bounded queue to background threads that compress them into a
+numbered sequence of PNG files, or pipe them into a video encoder. Nothing here needs pygame.
+'''
+import os
+import struct
+import subprocess
+import threading
+import time
+import zlib
+from queue import Queue
+
+import numpy as np
+
+#The default encoder for the paths that aren't a PNG sequence; {path}, {width}, {height} and
+#{fps} are filled in. The video is padded to even sizes, which yuv420p needs.
+FFMPEG = ['ffmpeg', '-loglevel', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb0',
+          '-s', '{width}x{height}', '-r', '{fps}', '-i', '-',
+          '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', '{path}']
+
+def _chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+def png(rgb, level = 1):
+    '''
+    Encodes an image as a PNG file. zlib does the work (and lets other threads run meanwhile).
+        Inputs:
+                rgb (np.ndarray): A (height, width, 3) array of uint8.
+                level (int): The zlib compression level, from 0 (none) to 9 (smallest). (1 by default)
+        Outputs:
+                data (bytes): The PNG file.
+    '''
+    height, width = rgb.shape[:2]
+    #Every row starts with its filter type, 0 (none).
+    rows = np.zeros((height, 1 + 3*width), dtype = np.uint8)
+    rows[:, 1:] = rgb.reshape(height, -1)
+    return (b'\x89PNG\r\n\x1a\n' +
+            _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            _chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) +
+            _chunk(b'IEND', b''))
+
+class FrameWriter:
+    '''
+    Writes frames from background threads. put only hands the frame to a bounded queue, so
+    the simulation keeps going while the frames are compressed and written; it waits only when
+    the writers fall queue frames behind (the time it waited is in waited). PNG files are
+    compressed by several threads at once (zlib releases the GIL); an encoder gets the frames
+    in order from a single thread.
+    '''
+    def __init__(self, path, size, fps = 60, encoder = None, queue = 16, level = 1, threads = None):
+        '''
+            Inputs:
+                    path (str): A pattern with the number of the frame, like 'frames/%05d.png',
+                        for a PNG sequence, or the output file of the encoder, like 'run.mp4'.
+                    size (tuple of int): The (width, height) of the frames.
+                Optional:
+                    fps (float): The frame rate of the video. (60 by default)
+                    encoder (list of str): The command of the encoder, which reads the raw RGBX
+                        frames from its standard input; {path}, {width}, {height} and {fps} are
+                        filled in. (ffmpeg, see FFMPEG, by default)
+                    queue (int): The largest number of frames waiting to be written. (16 by default)
+                    level (int): The zlib compression level of the PNG files. (1 by default)
+                    threads (int): The number of threads writing PNG files. (By default, one per
+                        CPU, at most 4)
+        '''
+        self.path = path
+        self.size = (int(size[0]), int(size[1]))
+        self.fps = fps
+        self.level = level
+        self.frames = 0
+        self.written = 0
+        self.waited = 0.0
+        self.error = None
+        self.queue = Queue(maxsize = queue)
+        self.encoder = None
+        self.lock = threading.Lock()
+
+        if '%' in path:
+            folder = os.path.dirname(path % 0)
+            if folder:
+                os.makedirs(folder, exist_ok = True)
+            threads = threads or min(4, os.cpu_count() or 1)
+        else:
+            fields = {'path': path, 'width': self.size[0], 'height': self.size[1], 'fps': fps}
+            command = [arg.format(**fields) for arg in (encoder or FFMPEG)]
+            self.encoder = subprocess.Popen(command, stdin = subprocess.PIPE)
+            threads = 1
+
+        self.threads = [threading.Thread(target = self._run, daemon = True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _write(self, number, frame):
+        if self.encoder is not None:
+            self.encoder.stdin.write(frame)
+            return
+        rgb = np.frombuffer(frame, dtype = np.uint8).reshape(self.size[1], self.size[0], 4)[..., :3]
+        with open(self.path % number, 'wb') as f:
+            f.write(png(rgb, self.level))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self._write(*item)
+                    with self.lock:
+                        self.written += 1
+            except Exception as error:
+                #Raised again in the thread of the simulation, by the next put, flush or close.
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('writing the frames to ' + self.path + ' failed') from self.error
+
+    def put(self, frame):
+        '''
+        Adds a frame, the raw RGBX bytes of its rows from top to bottom.
+        '''
+        self._check()
+        if len(frame) != 4*self.size[0]*self.size[1]:
+            raise ValueError('the frame is not ' + str(self.size[0]) + 'x' + str(self.size[1]) + ' RGBX')
+        start = time.perf_counter()
+        self.queue.put((self.frames, frame))
+        self.waited += time.perf_counter() - start
+        self.frames += 1
+
+    def flush(self):
+        '''
+        Waits until every frame put so far is written.
+        '''
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        '''
+        Writes the remaining frames and stops the threads (and waits for the encoder to finish).
+        '''
+        if not any(thread.is_alive() for thread in self.threads):
+            return
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.encoder is not None:
+            try:
+                self.encoder.stdin.close()
+            except OSError:
+                pass
+            if self.encoder.wait() and self.error is None:
+                raise RuntimeError('the encoder exited with code ' + str(self.encoder.returncode))
+        self._check()
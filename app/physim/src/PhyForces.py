@@ -0,0 +1,272 @@
+import numpy as np
+
+from .PhySimFunctions import expand_ranges
+
+#The depth of the tree: positions are rounded to a grid of 2**DEPTH x 2**DEPTH.
+DEPTH = 16
+
+def _spread(x):
+    '''
+    Moves the 16 lowest bits of x to the even bits, to interleave two coordinates.
+    '''
+    x = (x | (x << 8)) & 0x00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+    return x
+
+class QuadTree:
+    '''
+    A quadtree stored in flat arrays. The particles are sorted along a Z-order (Morton) curve,
+    so every node of the tree is a contiguous range [start, end) of the sorted particles and
+    the children of a node are contiguous in the arrays of the next level. Building it is a
+    sort and one pass per level. Nodes with at most bucket particles are leaves.
+    '''
+    def __init__(self, r, bucket = 8):
+        '''
+            Inputs:
+                    r (np.ndarray): The (N, 2) positions.
+                Optional:
+                    bucket (int): The largest number of particles in a leaf. (8 by default)
+        '''
+        N = len(r)
+        self.N = N
+        lo = r.min(axis = 0)
+        #A square box, a bit bigger so the highest coordinate still rounds inside it.
+        side = max(float((r.max(axis = 0) - lo).max()), 1e-12) * (1 + 1e-9)
+        cells = ((r - lo) * ((1 << DEPTH) / side)).astype(np.int64)
+        np.clip(cells, 0, (1 << DEPTH) - 1, out = cells)
+        keys = (_spread(cells[:, 0]) << 1) | _spread(cells[:, 1])
+        self.order = np.argsort(keys, kind = 'stable')
+        keys = keys[self.order]
+
+        #The nodes of each level: the first sorted particle of each distinct key prefix. We go
+        #down until every node is small enough (or we reach the bottom).
+        starts = []
+        levels = []
+        for level in range(DEPTH + 1):
+            prefix = keys >> 2*(DEPTH - level)
+            start = np.flatnonzero(np.r_[True, prefix[1:] != prefix[:-1]])
+            starts.append(start)
+            levels.append(np.full(len(start), level))
+            if np.diff(np.r_[start, N]).max() <= bucket:
+                break
+
+        offsets = np.cumsum([0] + [len(s) for s in starts])
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate([np.r_[s[1:], N] for s in starts])
+        self.level = np.concatenate(levels)
+        self.side = side / 2.0**self.level
+        self.count = self.end - self.start
+        #The children of a node are the nodes of the next level inside its range.
+        self.child = np.zeros(len(self.start), dtype = np.int64)
+        self.children = np.zeros(len(self.start), dtype = np.int64)
+        for l in range(len(starts) - 1):
+            nodes = slice(offsets[l], offsets[l + 1])
+            below = starts[l + 1]
+            first = np.searchsorted(below, self.start[nodes])
+            last = np.searchsorted(below, self.end[nodes])
+            self.child[nodes] = offsets[l + 1] + first
+            self.children[nodes] = last - first
+        self.leaf = (self.count <= bucket) | (self.children == 0)
+
+        #The leaves reached from the root split the particles in buckets.
+        nodes = np.zeros(1, dtype = np.int64)
+        buckets = []
+        while len(nodes):
+            leaf = self.leaf[nodes]
+            buckets.append(nodes[leaf])
+            _, k = expand_ranges(self.child[nodes[~leaf]], self.children[nodes[~leaf]])
+            nodes = k
+        #Ordered by their first particle (leaves found at different depths aren't), so their
+        #ranges of sorted particles come one after another, as reduceat needs.
+        buckets = np.concatenate(buckets)
+        self.buckets = buckets[np.argsort(self.start[buckets])]
+        #The box around the particles of each bucket.
+        rs = r[self.order]
+        first = self.start[self.buckets]
+        self.lo = np.column_stack([np.minimum.reduceat(rs[:, a], first) for a in (0, 1)])
+        self.hi = np.column_stack([np.maximum.reduceat(rs[:, a], first) for a in (0, 1)])
+
+    def moments(self, r, w):
+        '''
+        The total weight of every node and its center: weighted by |w|, or the plain mean of the
+        positions when all the weights of the node are 0.
+        '''
+        rs, ws = r[self.order], w[self.order]
+        a = np.abs(ws)
+        W = np.add.reduceat(ws, self.start)
+        A = np.add.reduceat(a, self.start)
+        center = np.add.reduceat(a[:, None] * rs, self.start) / np.where(A > 0, A, 1)[:, None]
+        empty = A == 0
+        if empty.any():
+            center[empty] = (np.add.reduceat(rs, self.start) / self.count[:, None])[empty]
+        return W, center
+
+    def field(self, r, w, theta, softening = 0, potential = True):
+        '''
+        For every particle i, the sum over the other particles j of w_j (r_i - r_j)/|r_i - r_j|^3
+        and of w_j/|r_i - r_j|. The tree is walked once for each bucket of particles: a node that
+        is far from the whole bucket (seen under an angle smaller than theta) counts as a single
+        particle in its center, and the particles of the leaves near the bucket are added one by one.
+            Outputs:
+                    E (np.ndarray): An (N, 2) array with the first sum.
+                    phi (np.ndarray): An (N,) array with the second one (None if not potential).
+        '''
+        N = self.N
+        W, center = self.moments(r, w)
+        E = np.zeros((N, 2))
+        phi = np.zeros(N) if potential else None
+        eps2 = softening*softening
+        order = self.order
+        start, end, count = self.start, self.end, self.count
+        bstart, bend = start[self.buckets], end[self.buckets]
+        #(bucket, node) pairs still to be handled, starting with every bucket and the root.
+        B = np.arange(len(self.buckets))
+        K = np.zeros(len(B), dtype = np.int64)
+        while len(B):
+            c = center[K]
+            gap = np.maximum(self.lo[B] - c, 0) + np.maximum(c - self.hi[B], 0)
+            dist2 = np.einsum('ij,ij->i', gap, gap) + eps2
+            #Nodes that share particles with the bucket (itself and its ancestors) are never far.
+            related = (start[K] < bend[B]) & (bstart[B] < end[K])
+            far = ~related & (self.side[K]**2 < theta*theta*dist2)
+
+            o, s = expand_ranges(bstart[B[far]], count[self.buckets[B[far]]])
+            i, k = order[s], K[far][o]
+            d = r[i] - center[k]
+            self._add(E, phi, i, W[k], d, np.einsum('ij,ij->i', d, d) + eps2)
+
+            near = ~far
+            leaf = near & self.leaf[K]
+            if leaf.any():
+                Bl, Kl = B[leaf], K[leaf]
+                o, s = expand_ranges(bstart[Bl], count[self.buckets[Bl]])
+                i, Kl = order[s], Kl[o]
+                o, s = expand_ranges(start[Kl], count[Kl])
+                i, j = i[o], order[s]
+                other = i != j
+                i, j = i[other], j[other]
+                d = r[i] - r[j]
+                self._add(E, phi, i, w[j], d, np.einsum('ij,ij->i', d, d) + eps2)
+
+            split = near & ~self.leaf[K]
+            owner, k = expand_ranges(self.child[K[split]], self.children[K[split]])
+            B = B[split][owner]
+            K = k
+        return E, phi
+
+    @staticmethod
+    def _add(E, phi, i, w, d, dist2):
+        '''
+        Adds the terms w d/|d|^3 and w/|d| (unless phi is None) to the particles i (zero 
+        distances add nothing).
+        '''
+        N = len(E)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            inv = np.where(dist2 > 0, 1/np.sqrt(dist2), 0)
+        s = w * inv**3
+        E[:, 0] += np.bincount(i, s * d[:, 0], minlength = N)
+        E[:, 1] += np.bincount(i, s * d[:, 1], minlength = N)
+        if phi is not None:
+            phi += np.bincount(i, w * inv, minlength = N)
+
+def direct_field(r, w, softening = 0, block = 1024):
+    '''
+    The same sums as QuadTree.field, exactly, adding every pair (in blocks of rows to bound the
+    memory). O(N^2): meant to check the tree.
+    '''
+    N = len(r)
+    E = np.zeros((N, 2))
+    phi = np.zeros(N)
+    eps2 = softening*softening
+    for a in range(0, N, block):
+        d = r[a:a + block, None, :] - r[None, :, :]
+        dist2 = np.einsum('ijk,ijk->ij', d, d) + eps2
+        #A particle doesn't act on itself.
+        idx = np.arange(a, min(a + block, N))
+        dist2[idx - a, idx] = np.inf
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            inv = np.where(dist2 > 0, 1/np.sqrt(dist2), 0)
+        E[a:a + block] = np.einsum('ij,ijk->ik', w * inv**3, d)
+        phi[a:a + block] = (w * inv).sum(axis = 1)
+    return E, phi
+
+class Forces:
+    '''
+    Long-range forces between all the particles: gravity, F = -G m_i m_j r/|r|^3, and the
+    Coulomb force, F = k q_i q_j r/|r|^3 (r goes from j to i). Every step, Simulation fills
+    the accelerations of the particles with them (plus a uniform field), using a Barnes-Hut
+    quadtree in O(N log N), or the exact sum over all the pairs in O(N^2).
+    '''
+    def __init__(self, G = 0, k = 0, theta = 0.5, softening = 0, method = 'tree', field = (0, 0)):
+        '''
+            Inputs:
+                    G (float): The gravitational constant (0, no gravity, by default).
+                    k (float): The Coulomb constant (0, no electric force, by default).
+                Optional:
+                    theta (float): The opening angle: a node of the tree of side s at a distance d
+                        counts as a single particle if s/d < theta. Smaller is more exact and
+                        slower; 0 is the exact sum. (0.5 by default)
+                    softening (float): A length added to the distances, as sqrt(r^2 + softening^2),
+                        to keep close encounters finite. (0 by default)
+                    method (str): 'tree' for Barnes-Hut, or 'direct' for the exact sum.
+                    field (list): A uniform acceleration added to every particle, like [0, g].
+        '''
+        if method not in ('tree', 'direct'):
+            raise ValueError("method must be 'tree' or 'direct'")
+        self.G = G
+        self.k = k
+        self.theta = theta
+        self.softening = softening
+        self.method = method
+        self.field = np.asarray(field, dtype = float)
+
+    def _sources(self, P):
+        '''
+        (the weights w_j, the factor of the particle i, the constant) for each active force.
+        '''
+        sources = []
+        if self.G:
+            sources.append((P.masses, P.masses, -self.G))
+        if self.k:
+            sources.append((P.charges, P.charges, self.k))
+        return sources
+
+    def _fields(self, P, potential = True):
+        r = P.positions
+        tree = QuadTree(r) if (self.method == 'tree' and P.N) else None
+        for w, f, c in self._sources(P):
+            if tree is None:
+                E, phi = direct_field(r, w, self.softening)
+            else:
+                E, phi = tree.field(r, w, self.theta, self.softening, potential)
+            yield E, phi, f, c
+
+    def forces(self, P):
+        '''
+        The (N, 2) array with the total force on each particle (without the uniform field).
+        '''
+        F = np.zeros((P.N, 2))
+        for E, _, f, c in self._fields(P, potential = False):
+            F += c * f[:, None] * E
+        return F
+
+    def accelerations(self, P):
+        return self.forces(P) / P.masses[:, None] + self.field
+
+    def apply(self, P):
+        '''
+        Overwrites the accelerations of the particles with those of the forces.
+        '''
+        P.accelerations = self.accelerations(P)
+
+    def potential(self, P):
+        '''
+        The potential energy of the long-range forces (each pair counted once, without the
+        uniform field).
+        '''
+        U = 0.0
+        for _, phi, f, c in self._fields(P):
+            U += 0.5 * c * float(f @ phi)
+        return U
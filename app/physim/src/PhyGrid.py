@@ -0,0 +1,280 @@
+import numpy as np
+
+from .PhySimFunctions import expand_ranges
+
+#The largest number of levels: particles smaller than that go to the last one.
+LEVELS = 8
+
+def _bounds(a):
+    '''
+    The lowest and the highest values of each column of an (N, 2) array (one column at a time,
+    which is much faster than reducing along axis 0).
+    '''
+    return np.array([a[:, 0].min(), a[:, 1].min()]), np.array([a[:, 0].max(), a[:, 1].max()])
+
+class _Level:
+    '''
+    A uniform grid with the particles of one size class, sorted by the key of their cell, so
+    entries[cellStart[c]:cellStart[c+1]] are the particles in the cell with key cellKeys[c]. The
+    keys of the cells of a column are consecutive, so a column of cells is a single range.
+    '''
+    def __init__(self, r, groups, index, spacing):
+        self.index = index
+        self.spacing = spacing
+        cells = self.cell(r[index])
+        #We leave an empty column and row of cells around the particles, so the keys of the
+        #neighbouring cells never wrap around to the other side of the grid (or to another group).
+        lo, hi = _bounds(cells)
+        self.origin = lo - 1
+        self.shape = hi - self.origin + 2
+        #The groups in the level, only needed by the queries of all the groups.
+        self.groups = None
+        keys = self.key(cells, groups[index])
+
+        order = np.argsort(keys, kind = 'stable')
+        self.cellKeys, cellStart = np.unique(keys[order], return_index = True)
+        self.cellStart = np.append(cellStart, len(index))
+        #The keys of the particles in the order of entries.
+        self.keys = keys[order]
+        self.entries = index[order]
+
+    def cell(self, points):
+        return np.floor(np.asarray(points) / self.spacing).astype(np.int64)
+
+    def key(self, cells, groups):
+        cells = cells - self.origin
+        return (groups * self.shape[0] + cells[..., 0]) * self.shape[1] + cells[..., 1]
+
+    def ranges(self, keys):
+        '''
+        The start and the end in entries of the cells with the given keys (an empty range for
+        the cells without particles).
+        '''
+        idx = np.minimum(np.searchsorted(self.cellKeys, keys), len(self.cellKeys) - 1)
+        found = self.cellKeys[idx] == keys
+        return np.where(found, self.cellStart[idx], 0), np.where(found, self.cellStart[idx + 1], 0)
+
+    def span(self, c0, c1, group):
+        '''
+        The particles in the rectangles of cells from c0 to c1 (both included) of the given group.
+            Outputs:
+                    owner (np.ndarray of int): The rectangle of each particle found.
+                    J (np.ndarray of int): The particles found.
+        '''
+        c0 = np.maximum(c0, self.origin + 1)
+        c1 = np.minimum(c1, self.origin + self.shape - 2)
+        columns = np.where(c1[:, 1] >= c0[:, 1], np.maximum(c1[:, 0] - c0[:, 0] + 1, 0), 0)
+        owner, x = expand_ranges(c0[:, 0], columns)
+        group = group[owner] if np.ndim(group) else group
+        first = self.key(np.column_stack((x, c0[owner, 1])), group)
+        last = first + (c1[owner, 1] - c0[owner, 1])
+        start = self.cellStart[np.searchsorted(self.cellKeys, first)]
+        end = self.cellStart[np.searchsorted(self.cellKeys, last, side = 'right')]
+        o, k = expand_ranges(start, end - start)
+        return owner[o], self.entries[k]
+
+    def pairs(self):
+        '''
+        Every pair of particles of the level in the same or in neighbouring cells, once.
+        '''
+        #We go through the particles in the order of entries, so the keys we look for are
+        #sorted (much faster to find than in a random order).
+        n = len(self.index)
+        slot = np.arange(n)
+        _, cellEnd = self.ranges(self.keys)
+
+        #Inside its own cell, a particle is paired only with the ones after it...
+        starts = [slot + 1]
+        counts = [cellEnd - slot - 1]
+        #...and with all the particles in half of the neighbouring cells, the other half
+        #will pair with it from their side.
+        for dx, dy in ((1, -1), (1, 0), (1, 1), (0, 1)):
+            start, end = self.ranges(self.keys + dx*self.shape[1] + dy)
+            starts.append(start)
+            counts.append(end - start)
+
+        owner, k = expand_ranges(np.concatenate(starts), np.concatenate(counts))
+        return self.entries[owner % n], self.entries[k]
+
+class Grid:
+    '''
+    A hierarchical grid: the particles are split in size classes (each one with radii up to
+    ratio times smaller than the one before) and every class gets its own uniform grid, with
+    cells of side 2*(its largest radius) + margin. Small particles don't share the cells of the
+    largest ones, so a few big disks among many small ones don't overload the cells, and with a
+    single size it's the plain spatial hash. It's a snapshot: build it again when the particles move.
+
+    Besides the candidate pairs for the collisions, it answers vectorized queries for many points
+    at once. The queries that can find several particles per point return two arrays, (Q, I):
+    for every match, the number of the point (or box) and the index of the particle, sorted by
+    point and then by particle. group restricts a query to the particles of a group (None, all).
+    '''
+    def __init__(self, r, radius, groups = 0, margin = 0, ratio = 2):
+        '''
+            Inputs:
+                    r (np.ndarray): The (N, 2) positions.
+                    radius (np.ndarray): The (N,) radii (or a single one).
+                Optional:
+                    groups (np.ndarray): The (N,) groups (0 by default); particles in different
+                        groups are never paired.
+                    margin (float): Added to the side of every cell, so pairs closer than the sum
+                        of their radii plus margin are still candidates. (0 by default)
+                    ratio (float): The ratio between the largest radii of consecutive levels. (2 by default)
+        '''
+        self.r = np.array(r, dtype = float).reshape(-1, 2)
+        N = len(self.r)
+        self.N = N
+        self.radius = np.broadcast_to(np.asarray(radius, dtype = float), (N,))
+        self.groups = np.broadcast_to(np.asarray(groups, dtype = np.int64), (N,))
+        self.margin = margin
+        self.levels = []
+        if not N:
+            return
+
+        rmax = self.radius.max()
+        if rmax <= 0 or self.radius.min() > rmax/ratio:
+            classes = [np.arange(N)]
+        else:
+            with np.errstate(divide = 'ignore'):
+                size = np.floor(np.log(rmax / self.radius) / np.log(ratio))
+            size = np.minimum(np.nan_to_num(size, posinf = LEVELS), LEVELS - 1).astype(np.int64)
+            classes = [np.flatnonzero(size == s) for s in np.flatnonzero(np.bincount(size))]
+        for index in classes:
+            spacing = 2*self.radius[index].max() + margin
+            self.levels.append(_Level(self.r, self.groups, index, spacing if spacing > 0 else 1.0))
+
+    def _span(self, level, c0, c1, group):
+        if group is not None:
+            return level.span(c0, c1, group)
+        if level.groups is None:
+            level.groups = np.unique(self.groups[level.index])
+        found = [level.span(c0, c1, g) for g in level.groups]
+        return np.concatenate([f[0] for f in found]), np.concatenate([f[1] for f in found])
+
+    def pairs(self):
+        '''
+        The broadphase: every pair of particles of the same group that could be closer than the
+        sum of their radii plus margin, each pair only once. Pairs of the same level come from
+        the same or neighbouring cells; a particle of a smaller level is looked up in the 3x3 cells
+        around it in each larger level, whose cells are at least as big as the sum of the radii.
+            Outputs:
+                    I, J (np.ndarray of int): The indices of the particles of each candidate pair.
+        '''
+        I, J = [np.zeros(0, dtype = np.int64)], [np.zeros(0, dtype = np.int64)]
+        for a, level in enumerate(self.levels):
+            i, j = level.pairs()
+            I.append(i)
+            J.append(j)
+            for small in self.levels[a + 1:]:
+                #Sorted by their cell in this level, so the keys we look for are sorted too.
+                c = level.cell(self.r[small.index])
+                order = np.argsort(level.key(c, self.groups[small.index]), kind = 'stable')
+                owner, j = level.span(c[order] - 1, c[order] + 1, self.groups[small.index[order]])
+                I.append(small.index[order[owner]])
+                J.append(j)
+        return np.concatenate(I), np.concatenate(J)
+
+    def _boxes(self, lo, hi, group):
+        '''
+        The candidates in the boxes [lo, hi] of every level: (box, particle) pairs, unsorted.
+        '''
+        Q, I = [np.zeros(0, dtype = np.int64)], [np.zeros(0, dtype = np.int64)]
+        for level in self.levels:
+            q, i = self._span(level, level.cell(lo), level.cell(hi), group)
+            Q.append(q)
+            I.append(i)
+        return np.concatenate(Q), np.concatenate(I)
+
+    @staticmethod
+    def _sorted(Q, I, *more):
+        order = np.lexsort((I, Q))
+        return (Q[order], I[order]) + tuple(m[order] for m in more)
+
+    def region(self, lo, hi, group = None):
+        '''
+        The particles whose centers are inside the boxes from lo to hi.
+            Inputs:
+                    lo, hi (np.ndarray): The lower and upper corners, (M, 2) arrays or a single point.
+            Outputs:
+                    Q, I (np.ndarray of int): The box and the particle of every match.
+        '''
+        lo = np.asarray(lo, dtype = float).reshape(-1, 2)
+        hi = np.broadcast_to(np.asarray(hi, dtype = float).reshape(-1, 2), lo.shape)
+        Q, I = self._boxes(lo, hi, group)
+        r = self.r[I]
+        inside = np.all((lo[Q] <= r) & (r <= hi[Q]), axis = 1)
+        return self._sorted(Q[inside], I[inside])
+
+    def within(self, points, distance, group = None):
+        '''
+        The particles whose centers are at most distance away from the points.
+            Inputs:
+                    points (np.ndarray): An (M, 2) array or a single point.
+                    distance (float or np.ndarray): The distance, one for all or one per point.
+            Outputs:
+                    Q, I (np.ndarray of int): The point and the particle of every match.
+                    d (np.ndarray): Their distances.
+        '''
+        points = np.asarray(points, dtype = float).reshape(-1, 2)
+        distance = np.broadcast_to(np.asarray(distance, dtype = float), (len(points),))[:, None]
+        Q, I = self._boxes(points - distance, points + distance, group)
+        d = self.r[I] - points[Q]
+        d = np.sqrt(np.einsum('ij,ij->i', d, d))
+        close = d <= distance[Q, 0]
+        return self._sorted(Q[close], I[close], d[close])
+
+    def nearest(self, points, k = 1, group = None):
+        '''
+        The k particles with the nearest centers to each point. The search radius starts from
+        the mean spacing of the particles and doubles for the points with fewer than k matches.
+            Outputs:
+                    I (np.ndarray of int): An (M, k) array with the particles, nearest first
+                        (-1 when there are fewer than k particles).
+                    d (np.ndarray): An (M, k) array with their distances (inf for the missing ones).
+        '''
+        points = np.asarray(points, dtype = float).reshape(-1, 2)
+        M = len(points)
+        I = np.full((M, k), -1, dtype = np.int64)
+        D = np.full((M, k), np.inf)
+        if not (self.N and M and k):
+            return I, D
+
+        lo, hi = _bounds(self.r)
+        #Beyond this radius a point sees every particle.
+        far = np.maximum(np.abs(points - lo), np.abs(points - hi))
+        reach = np.sqrt(np.einsum('ij,ij->i', far, far))
+        area = max(np.prod(hi - lo), 1e-12)
+        R = np.full(M, np.sqrt(k * area / (np.pi * self.N)))
+        todo = np.arange(M)
+        while len(todo):
+            Q, J, d = self.within(points[todo], R[todo], group)
+            counts = np.bincount(Q, minlength = len(todo))
+            done = (counts >= k) | (R[todo] >= reach[todo])
+
+            #The matches are sorted by point; we sort them by distance inside each point.
+            order = np.lexsort((J, d, Q))
+            Q, J, d = Q[order], J[order], d[order]
+            rank = np.arange(len(Q)) - (np.cumsum(counts) - counts)[Q]
+            take = done[Q] & (rank < k)
+            I[todo[Q[take]], rank[take]] = J[take]
+            D[todo[Q[take]], rank[take]] = d[take]
+
+            todo = todo[~done]
+            R[todo] *= 2
+        return I, D
+
+    def lookup(self, points, tolerance = 0, group = None):
+        '''
+        The particle with the nearest center to each point, if it's at most tolerance away (the
+        one with the lowest index on ties).
+            Outputs:
+                    I (np.ndarray of int): The (M,) particles (-1 where there is none).
+        '''
+        points = np.asarray(points, dtype = float).reshape(-1, 2)
+        Q, J, d = self.within(points, tolerance, group)
+        I = np.full(len(points), -1, dtype = np.int64)
+        order = np.lexsort((J, d, Q))
+        Q, J = Q[order], J[order]
+        first = np.r_[True, Q[1:] != Q[:-1]] if len(Q) else np.zeros(0, dtype = bool)
+        I[Q[first]] = J[first]
+        return I
@@ -0,0 +1,67 @@
+import numpy as np
+
+class NeighbourList:
+    '''
+    A Verlet neighbour list: the pairs of particles closer than the sum of their radii plus a
+    skin, found once with the spatial hash and reused while no particle has moved more than
+    skin/2 since then (until that, no pair outside the list can be touching). Collisions and
+    walls move the particles too; they are counted in the displacement like everything else.
+    '''
+    def __init__(self, P, skin):
+        '''
+            Inputs:
+                    P (physim.Particles): The particles.
+                    skin (float): The extra distance of the pairs in the list. A bigger skin means
+                        fewer rebuilds but more pairs to check every step.
+        '''
+        self.P = P
+        self.skin = skin
+        self.I = self.J = None
+        #The positions at the last build.
+        self.r0 = None
+        #How many times the list was built, and in how many calls to pairs.
+        self.builds = 0
+        self.calls = 0
+
+    def stale(self):
+        '''
+        If the list must be built again: the particles changed, or one of them moved more than skin/2.
+        '''
+        P = self.P
+        if (self.r0 is None) or (len(self.r0) != P.N):
+            return True
+        d = P.positions - self.r0
+        return np.einsum('ij,ij->i', d, d).max(initial = 0) > (self.skin/2)**2
+
+    def build(self):
+        '''
+        Finds all the pairs closer than the sum of their radii plus the skin.
+        '''
+        P = self.P
+        P.Hash(self.skin)
+        I, J = P.Pairs()
+        d = P.positions[J] - P.positions[I]
+        reach = P.radii[I] + P.radii[J] + self.skin
+        near = np.einsum('ij,ij->i', d, d) < reach * reach
+        self.I, self.J = I[near], J[near]
+        self.r0 = P.positions.copy()
+        self.builds += 1
+
+    def pairs(self):
+        '''
+        The candidate pairs (I, J) for Particles.resolve, building the list again if needed.
+            Outputs:
+                    I, J (np.ndarray of int): The indices of the particles of each pair.
+                    rebuilt (boolean): If the list was built in this call.
+        '''
+        self.calls += 1
+        rebuilt = self.stale()
+        if rebuilt:
+            self.build()
+        return self.I, self.J, rebuilt
+
+    def rebuild_rate(self):
+        '''
+        The fraction of the calls to pairs that built the list (1 means every step).
+        '''
+        return self.builds / self.calls if self.calls else 0.0
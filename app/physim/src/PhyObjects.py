@@ -1,9 +1,51 @@
 import numpy as np
-import pygame
-from random import randint, random
+from random import random
 import os 
+import time
+from .PhySimFunctions import elastic_collision, expand_ranges, disjoint_pairs
+from .PhyRecorder import Recorder, Trajectory
+from .PhyStats import Stats
+from .PhyObservables import Observables
+from . import PhyCheckpoint
+from .PhyNeighbours import NeighbourList
+from .PhyGrid import Grid
+
+class _Column:
+    '''
+    Exposes one row of a physim.Particles array as an attribute of a MassPoint view, 
+    reading and writing straight into the array.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, p, owner = None):
+        if p is None:
+            return self
+        return getattr(p._P, self.name)[p._i]
+
+    def __set__(self, p, value):
+        getattr(p._P, self.name)[p._i] = value
+
+class _ColorColumn(_Column):
+    def __get__(self, p, owner = None):
+        if p is None:
+            return self
+        return tuple(int(c) for c in getattr(p._P, self.name)[p._i])
 
 class MassPoint:
+    #A MassPoint doesn't own its data, it's a view of the row _i of the arrays of the 
+    #physim.Particles _P. A free point (one that isn't in any Particles yet) lives in a 
+    #one-row Particles of its own.
+    __slots__ = ('_P', '_i')
+
+    r = _Column('_r')
+    v = _Column('_v')
+    a = _Column('_a')
+    m = _Column('_m')
+    q = _Column('_q')
+    radius = _Column('_radius')
+    color = _ColorColumn('_color')
+
     def __init__(self, r_0, v_0, m, a_0 = [0,0], q = 0, radius = 1, color = (0, 180, 200)):
         '''
         Defines a point mass with its initial position and 
@@ -18,13 +60,18 @@ class MassPoint:
                     radius (float): Because we can't visualize points, a radius to graph a circle is needed.
                     color (tuple (int, int, int)): The color in RGB format.
         '''
-        self.r = np.array(r_0)
-        self.v = np.array(v_0)
-        self.m = m
-        self.a = np.array(a_0)
-        self.q = q
-        self.radius = radius
-        self.color = color
+        self._P = Particles()
+        self._i = self._P._extend(r_0, v_0, m, a_0, q, radius, color)
+
+    @classmethod
+    def _view(cls, P, i):
+        '''
+        Creates a MassPoint that views the row i of the physim.Particles P without copying anything.
+        '''
+        p = cls.__new__(cls)
+        p._P = P
+        p._i = i
+        return p
 
     def draw(self, win):
         '''
@@ -33,7 +80,8 @@ class MassPoint:
             Inputs:
                     win (pygame.Surface): The surface on which the particle will be drawn.
         '''
-        pygame.draw.circle(win, self.color, (self.r[0], self.r[1]), self.radius)
+        from .PhyRender import draw_point
+        draw_point(win, self)
     
     def update(self, dt):
         '''
@@ -43,8 +91,8 @@ class MassPoint:
                     dt (float): The length of the time step.
         '''
         #self.fieldUp()
-        self.r = self.r + dt * self.v
-        self.v = self.v + dt * self.a
+        self.r += dt * self.v
+        self.v += dt * self.a
     
     def wall_collision(self, wall):
         '''
@@ -96,6 +144,8 @@ class MassPoint:
         Handles the collisions particle-particle.
             Inputs:
                     p2 (MassPoint object): The physim.MassPoint that could collide with the particle.
+            Outputs:
+                    collided (boolean): If the particles collided.
         '''
         #We named d the distance between both particles.
         d = p2.r - self.r
@@ -119,12 +169,9 @@ class MassPoint:
             #We calculate the final velocity assuming that the collision is elastic, therefore, 
             #the energy and momentum right before the collision are the same as the energy and 
             # momentum after the hit.
-            
-            c1 = (self.m - p2.m)/(self.m + p2.m)
-            c2 = 2*self.m / (self.m + p2.m)
-            v_r = self.v - p2.v
-            self.v = c1*v_r + p2.v
-            p2.v = c2*v_r + p2.v
+            self.v, p2.v = elastic_collision(self.v, p2.v, self.m, p2.m)
+            return True
+        return False
 
     
     def __str__(self):
@@ -156,119 +203,473 @@ class Wall:
                     win (pygame.Surface): The surface on which the particle will be drawn.
                     color (tuple (int, int, int)): The color in RGB format.
         '''
-        rectangle = pygame.Rect(self.r[0] - self.width/2, self.r[1] - self.height/2, self.width, self.height)
-        pygame.draw.rect(win, color, rectangle)
+        from .PhyRender import draw_wall
+        draw_wall(win, self, color)
+
+#The number of grid cells per wall that Walls aims for.
+CELLS_PER_WALL = 64
+
+class Walls:
+    '''
+    A set of walls packed in arrays and indexed in a grid, so that the collisions of all the 
+    particles with all the walls are solved at once. Walls never move, so the grid is only 
+    built again when the particles get bigger. Its cells are sized by the walls, not by the
+    particles, so small particles don't split the walls in millions of cells.
+    '''
+    def __init__(self, *W):
+        self.W = W
+        self.N = len(W)
+        self.centers = np.array([w.r for w in W], dtype = float).reshape(-1, 2)
+        self.half = np.array([(w.width/2, w.height/2) for w in W], dtype = float).reshape(-1, 2)
+        self.lo = self.centers - self.half
+        self.hi = self.centers + self.half
+        self.spacing = None
+        self.margin = -1
+        #The momentum given to each wall by the bounces so far, along x and y (for the pressure).
+        self.impulse = np.zeros((self.N, 2))
+
+    def __iter__(self):
+        return iter(self.W)
+
+    def __len__(self):
+        return self.N
+
+    def cellSize(self, margin):
+        '''
+        The side of the cells of the grid: the smallest one that keeps the cells of all the walls
+        (grown by margin) under CELLS_PER_WALL per wall.
+        '''
+        size = self.hi - self.lo + 2*margin
+        #The cells of a wall are about (w/s + 1)*(h/s + 1), so we solve A/s^2 + L/s = budget.
+        A = np.sum(size[:, 0] * size[:, 1])
+        L = np.sum(size)
+        budget = CELLS_PER_WALL * max(self.N, 1)
+        spacing = (L + np.sqrt(L*L + 4*A*budget)) / (2*budget)
+        return spacing if spacing > 0 else 1.0
+
+    def Hash(self, margin, spacing = None):
+        '''
+        Puts every wall in all the grid cells touched by its box grown by margin, so a particle 
+        of radius up to margin can only hit the walls listed in the cell of its center.
+            Inputs:
+                    margin (float): The largest radius of the particles.
+                Optional:
+                    spacing (float): The side of the cells. (By default, cellSize(margin))
+        '''
+        if spacing is None or spacing <= 0:
+            spacing = self.cellSize(margin)
+        self.spacing = spacing
+        self.margin = margin
+        lo = np.floor((self.lo - margin) / spacing).astype(np.int64)
+        hi = np.floor((self.hi + margin) / spacing).astype(np.int64)
+        self.cellOrigin = lo.min(0)
+        self.gridShape = hi.max(0) - self.cellOrigin + 1
+
+        #Each wall covers a rectangle of nx*ny cells; we list them all.
+        n = hi - lo + 1
+        wall, k = expand_ranges(np.zeros(self.N, dtype = np.int64), n[:, 0] * n[:, 1])
+        cells = lo[wall] + np.column_stack((k // n[wall, 1], k % n[wall, 1]))
+        keys = self._cellKeys(cells)
+
+        order = np.argsort(keys, kind = 'stable')
+        self.cellKeys, cellStart = np.unique(keys[order], return_index = True)
+        self.cellStart = np.append(cellStart, len(keys))
+        self.cellEntries = wall[order]
+
+    def _cellKeys(self, cells):
+        cells = cells - self.cellOrigin
+        return cells[..., 0] * self.gridShape[1] + cells[..., 1]
+
+    def Pairs(self, P):
+        '''
+        The (particle, wall) pairs that could be in contact, ordered by particle and then by wall.
+            Inputs:
+                    P (physim.Particles): The particles.
+            Outputs:
+                    I, K (np.ndarray of int): The indices of the particles and of the walls of each pair.
+        '''
+        margin = P.radii.max()
+        if margin > self.margin:
+            self.Hash(margin)
+
+        cells = np.floor(P.positions / self.spacing).astype(np.int64)
+        cells = np.clip(cells, self.cellOrigin, self.cellOrigin + self.gridShape - 1)
+        keys = self._cellKeys(cells)
+
+        idx = np.minimum(np.searchsorted(self.cellKeys, keys), len(self.cellKeys) - 1)
+        found = self.cellKeys[idx] == keys
+        start = np.where(found, self.cellStart[idx], 0)
+        end = np.where(found, self.cellStart[idx + 1], 0)
+
+        I, k = expand_ranges(start, end - start)
+        return I, self.cellEntries[k]
+
+    def overlapping(self, P, I, K):
+        '''
+        Filters the (particle, wall) pairs that overlap.
+        '''
+        r = P._r[I]
+        radius = P._radius[I, None]
+        return np.all((r + radius > self.lo[K]) & (r - radius < self.hi[K]), axis = 1)
+
+    def collide(self, P):
+        '''
+        Handles the collisions of all the particles with all the walls at once, with the same 
+        rules as MassPoint.wall_collision. A particle touching several walls is resolved against 
+        them one after another, in the order of the walls. The momentum of each bounce is added 
+        to self.impulse.
+            Inputs:
+                    P (physim.Particles): The particles.
+            Outputs:
+                    contacts (int): The number of particle-wall collisions resolved.
+        '''
+        if not (self.N and P.N):
+            return 0
+
+        I, K = self.Pairs(P)
+        hit = self.overlapping(P, I, K)
+        I, K = I[hit], K[hit]
+        r, v, m, radius = P._r, P._v, P._m, P._radius
+        contacts = 0
+
+        while len(I):
+            keep = disjoint_pairs(I, None, P.N)
+            i, k = I[keep], K[keep]
+            contacts += len(i)
+
+            #The overlap in each axis is the smallest one of both sides.
+            ri = radius[i, None]
+            overlap = np.minimum(r[i] + ri - self.lo[k], self.hi[k] - (r[i] - ri))
+            #Bounce in the axis with less overlap (in both axes if we hit a corner).
+            for axis, bounce in ((1, overlap[:, 0] >= overlap[:, 1]), (0, overlap[:, 0] <= overlap[:, 1])):
+                j, kj = i[bounce], k[bounce]
+                d = np.where(r[j, axis] < self.centers[kj, axis], -1, 1)
+                r[j, axis] = self.centers[kj, axis] + d*(self.half[kj, axis] + radius[j])
+                np.add.at(self.impulse, (kj, axis), 2*m[j]*np.abs(v[j, axis]))
+                v[j, axis] = -v[j, axis]
+
+            I, K = I[~keep], K[~keep]
+            hit = self.overlapping(P, I, K)
+            I, K = I[hit], K[hit]
+
+        return contacts
+
+class _Array:
+    '''
+    Exposes the first N rows of one of the physim.Particles buffers.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, P, owner = None):
+        if P is None:
+            return self
+        return getattr(P, self.name)[:P.N]
+
+    def __set__(self, P, value):
+        getattr(P, self.name)[:P.N] = value
 
 class Particles:
+    '''
+    A set of particles stored as a structure of arrays: the positions, velocities and 
+    accelerations of all the particles are (N, 2) arrays, and the masses, charges, radii and 
+    colors are (N,) and (N, 3) arrays. Each particle can still be handled as a MassPoint, 
+    which is a view of its row.
+    '''
+    #(buffer name, shape of a row, dtype)
+    _FIELDS = (
+        ('_r', (2,), float),
+        ('_v', (2,), float),
+        ('_a', (2,), float),
+        ('_m', (), float),
+        ('_q', (), float),
+        ('_radius', (), float),
+        ('_color', (3,), np.uint8),
+        ('_group', (), np.int64)
+    )
+    #The buffers grow at least this much each time we run out of room.
+    CHUNK = 64
+
+    positions = _Array('_r')
+    velocities = _Array('_v')
+    accelerations = _Array('_a')
+    masses = _Array('_m')
+    charges = _Array('_q')
+    radii = _Array('_radius')
+    colors = _Array('_color')
+    #Particles in different groups never collide (see physim.Ensemble).
+    groups = _Array('_group')
+
     def __init__ (self, *P):
-        self.P = P
-        self.N = len(P)
+        self.N = 0
+        #The physim.Grid of the last call to Hash (or to grid).
+        self.spatial = None
+        for name, shape, dtype in self._FIELDS:
+            #Empty buffers are never written, so all the empty Particles share them.
+            setattr(self, name, np.zeros((len(P),) + shape, dtype = dtype) if P else _EMPTY[name])
+
+        for p in P:
+            self.add(p)
+
+    @property
+    def P(self):
+        return tuple(self)
+
+    def __len__(self):
+        return self.N
 
     def __iter__(self):
-        return iter(self.P)
+        return (MassPoint._view(self, i) for i in range(self.N))
     
     def __getitem__(self, index):
-        if isinstance(index, (list, tuple, np.ndarray)):
-            for p in self:
-                if (p.r[0] == index[0]) and (p.r[1] == index[1]):
-                    return p
-        elif np.issubdtype(type(index), np.integer):
-            return self.P[index]
-        
+        if isinstance(index, (int, np.integer)):
+            if not -self.N <= index < self.N:
+                raise IndexError('particle index out of range')
+            return MassPoint._view(self, int(index) % self.N)
+
+        elif isinstance(index, (list, tuple, np.ndarray)):
+            #The particle at exactly that point. The last grid may be out of date, so what it finds
+            #is checked, and on a miss we look again in a new one.
+            point = np.asarray(index[:2], dtype = float)
+            spatial = self.spatial
+            while True:
+                fresh = (spatial is None) or (spatial.N != self.N)
+                if fresh:
+                    spatial = self.grid()
+                i = spatial.lookup(point)[0]
+                if (i >= 0) and np.array_equal(self._r[i], point):
+                    return MassPoint._view(self, int(i))
+                if fresh:
+                    break
+                spatial = None
+
         else:
             raise TypeError(str(type(index)) + ' object not supported')
+
+    def _reserve(self, n):
+        '''
+        Makes room for at least n particles, growing the buffers geometrically so that adding 
+        particles one by one is amortized O(1). Empty buffers get exactly n rows, so a free
+        MassPoint only takes one.
+        '''
+        capacity = len(self._m)
+        if n <= capacity:
+            return
+        capacity = max(n, 2*capacity, self.CHUNK) if capacity else n
+        for name, shape, dtype in self._FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + shape, dtype = dtype)
+            if self.N:
+                new[:self.N] = old[:self.N]
+            setattr(self, name, new)
+
+    def _extend(self, r, v, m, a = 0, q = 0, radius = 1, color = (0, 180, 200), group = 0):
+        '''
+        Appends a block of particles at once; every input is broadcast to the size of r.
+        Returns the index of the first new particle.
+        '''
+        r = np.asarray(r, dtype = float).reshape(-1, 2)
+        n = len(r)
+        start = self.N
+        self._reserve(start + n)
+        end = start + n
+        self._r[start:end] = r
+        self._v[start:end] = v
+        self._a[start:end] = a
+        self._m[start:end] = m
+        self._q[start:end] = q
+        self._radius[start:end] = radius
+        self._color[start:end] = color
+        self._group[start:end] = group
+        self.N = end
+        return start
         
+    @classmethod
+    def from_arrays(cls, r, v = 0, m = 1, a = 0, q = 0, radius = 1, color = (0, 180, 200), group = 0):
+        '''
+        Builds the particles from arrays in one go, without creating any MassPoint.
+            Inputs:
+                    r (np.ndarray): An (N, 2) array with the positions.
+                Optional:
+                    v, a (np.ndarray): The velocities and accelerations, (N, 2) arrays or a 
+                        single vector for all. (0 by default)
+                    m, q, radius (np.ndarray): The masses (1 by default), charges (0 by default) 
+                        and radii (1 by default), (N,) arrays or a single number.
+                    color (np.ndarray): An (N, 3) array of RGB colors or a single color.
+                    group (np.ndarray): The groups (0 by default).
+        '''
+        P = cls()
+        P._extend(r, v, m, a, q, radius, color, group)
+        return P
+
     def add(self, x):
-        self.P += (x,)
-        self.N += 1
+        '''
+        Copies the MassPoint x at the end of the arrays; from now on x is a view of that row.
+        '''
+        i = self._extend(x.r, x.v, x.m, x.a, x.q, x.radius, x.color)
+        x._P = self
+        x._i = i
+
+    def update(self, dt):
+        '''
+        Updates all the particles at once with the same finite step approximation 
+        used by MassPoint.update.
+            Inputs:
+                    dt (float): The length of the time step.
+        '''
+        self.positions += dt * self.velocities
+        self.velocities += dt * self.accelerations
+
+    def kick(self, dt):
+        '''
+        Changes the velocities of all the particles with their accelerations during dt.
+        '''
+        self.velocities += dt * self.accelerations
+
+    def drift(self, dt):
+        '''
+        Moves all the particles with their velocities during dt.
+        '''
+        self.positions += dt * self.velocities
     
     def MeanRadius(self):
-        meanR = 0
-        for p in self:
-            meanR += p.radius
-        return meanR/self.N
+        return self.radii.mean()
     
+    def cellSize(self):
+        '''
+        The side of the cells of the largest level of the spatial hash, the smallest size for 
+        which two touching particles always end up in the same or in neighbouring cells.
+        '''
+        return 2*self.radii.max()
+
     def intCoords(self, num, spacing = 0):
         if spacing == 0:
-            spacing = 3*self.MeanRadius()
+            spacing = self.cellSize()
         
-        return int(num/spacing)
-    
-    def hashCoords(self, r):
-        size = 2*self.N 
-        h = (r[0] * 92837111) ^ (r[1] * 689287499) ^ (283923481)
-        return abs(h)%(size)
-
-    def hashPos (self, r):
-        x1 = self.intCoords(r[0])
-        y1 = self.intCoords(r[1])
-        return self.hashCoords([x1, y1])
+        return np.floor(np.asarray(num) / spacing).astype(np.int64)
+
+    def grid(self, margin = 0):
+        '''
+        A physim.Grid with the current positions, for spatial queries (within, nearest, region
+        and lookup). It's a snapshot: get a new one after the particles move.
+        '''
+        self.spatial = Grid(self.positions, self.radii, self.groups, margin)
+        return self.spatial
+
+    def Hash(self, margin = 0):
+        '''
+        Bins all the particles in a hierarchical grid (physim.Grid), one level for each size 
+        class, with cells of side 2*(the largest radius of the level) + margin.
+        '''
+        return self.grid(margin)
     
-    def Hash(self):
-        size = 2*self.N
-        
-        cellStart = np.zeros(size + 1, dtype = int)
-        cellEntries = np.zeros(self.N, dtype = int)
+    def query(self, p, maxDist, group = 0):
+        '''
+        Finds the particles whose centers are inside a square of side 2*maxDist around p.
+        It must be called after Hash.
+            Inputs:
+                    p (MassPoint or array): The particle (or the point) in the center of the search.
+                    maxDist (float): Half the side of the square.
+                    group (int): Only look among the particles of this group. (0 by default)
+            Outputs:
+                    querryIds (np.ndarray of int): The indices of the particles found.
+                    querrySize (int): How many particles were found.
+        '''
+        r = p.r if isinstance(p, MassPoint) else np.asarray(p, dtype = float)
+        _, querryIds = self.spatial.region(r - maxDist, r + maxDist, group)
+        return querryIds, len(querryIds)
 
-        for p in self.P:
-            h = self.hashPos(p.r)
-            cellStart[h] += 1
+    def Pairs(self):
+        '''
+        The broadphase: every pair of particles close enough to touch (in the same or in 
+        neighbouring cells of the grid), each pair only once. It must be called after Hash.
+            Outputs:
+                    I, J (np.ndarray of int): The indices of the particles of each candidate pair.
+        '''
+        return self.spatial.pairs()
 
-        start = 0
-        for i in range(size):
-            start += cellStart[i]
-            cellStart[i] = start
-        
-        cellStart[size] = start
+    def overlapping(self, I, J):
+        '''
+        Filters the pairs (I, J) that overlap.
+        '''
+        d = self._r[J] - self._r[I]
+        reach = self._radius[I] + self._radius[J]
+        return np.einsum('ij,ij->i', d, d) < reach * reach
 
-        for i in range(self.N):
-            h = self.hashPos(self.P[i].r)
-            cellStart[h] -= 1
-            j = cellStart[h]
-            cellEntries[j] = i
+    def resolve(self, I, J):
+        '''
+        The narrowphase: resolves the elastic collisions of all the overlapping pairs among 
+        (I, J) in batch, with the same rules as MassPoint.particle_collision. A particle that 
+        hits several others is resolved against them one after another, in the order of the pairs.
+            Inputs:
+                    I, J (np.ndarray of int): The indices of the particles of each candidate pair.
+            Outputs:
+                    collisions (int): The number of collisions resolved.
+        '''
+        r, v, m, radius = self._r, self._v, self._m, self._radius
+        hit = self.overlapping(I, J)
+        I, J = I[hit], J[hit]
+        collisions = 0
 
-        self.cellStart = cellStart
-        self.cellEntries = cellEntries
-    
-    def query(self, p, maxDist):
+        while len(I):
+            keep = disjoint_pairs(I, J, self.N)
+            i, j = I[keep], J[keep]
+            collisions += len(i)
 
-        r_0 = np.array([self.intCoords(p.r[0] - maxDist), self.intCoords(p.r[1] - maxDist)])
-        r_1 = np.array([self.intCoords(p.r[0] + maxDist), self.intCoords(p.r[1] + maxDist)])
+            d = r[j] - r[i]
+            d_len = np.sqrt(np.einsum('ij,ij->i', d, d))
+            #Particles in the same spot are pulled apart in a random direction.
+            same = d_len == 0
+            theta = 2* np.pi * np.random.rand(same.sum())
+            d[same] = np.column_stack((np.cos(theta), np.sin(theta)))
+            d_len[same] = 1
+            d_unit = d / d_len[:, None]
+            d[same] = 0
 
-        querrySize = 0
-        querryIds = -np.ones(self.N, dtype = int)
+            midpoint = d*(1/2) + r[i]
+            r[i] = midpoint - d_unit*radius[i, None]
+            r[j] = midpoint + d_unit*radius[j, None]
 
-        for i in range(r_0[0], r_1[0] + 1):
-            for j in range(r_0[1], r_1[1] + 1):
-                h = self.hashCoords([i,j])
-                start = self.cellStart[h]
-                end = self.cellStart[h+1]
+            v[i], v[j] = elastic_collision(v[i], v[j], m[i, None], m[j, None])
 
-                for k in range(start, end):
-                    if self.cellEntries[k] not in querryIds:
-                        querryIds[querrySize] = self.cellEntries[k]
-                        querrySize += 1
-        
-        return querryIds, querrySize
+            #Moving a particle may have solved (or caused) the overlap of its other pairs.
+            I, J = I[~keep], J[~keep]
+            hit = self.overlapping(I, J)
+            I, J = I[hit], J[hit]
+
+        return collisions
     
     def Collision(self):
-        checked = []
-        for i in range(self.N):
-            Ids, Size = self.query(self[i], 2*self[i].radius)
-            for k in range(Size):
-                j = Ids[k]
-                if ({i, j} not in checked) and (j != i):
-                    self[i].particle_collision(self[j])
-                    checked.append({i,j})
-
+        '''
+        Handles all the collisions between particles, using the spatial hash built by Hash.
+        '''
+        I, J = self.Pairs()
+        return self.resolve(I, J)
 
-        
 
+#The buffers of an empty Particles, by name.
+_EMPTY = {name: np.zeros((0,) + shape, dtype = dtype) for name, shape, dtype in Particles._FIELDS}
 
 class Gas(Particles):
-    def __init__(self, r_0, N, m, energy, width, height, radius = 10, SCALE = 10):
+    def __init__(self, r_0, N, m, energy, width, height, radius = 10, SCALE = 10, placement = None, walls = ()):
+        '''
+            Inputs:
+                    r_0 (list): The center of the box.
+                    N (int): The number of particles.
+                    m (float): The mass of each particle.
+                    energy (float): The total kinetic energy, split at random between the particles.
+                    width, height (float): The size of the box.
+                    radius (float): The radius of the particles. (10 by default)
+                Optional:
+                    placement (str): 'poisson' for random positions without overlaps, 'lattice' for 
+                        a jittered lattice without overlaps (denser and much faster for millions of
+                        particles), or 'random' for random integer positions that may overlap.
+                        (By default 'poisson' up to PhyPlacement.POISSON_LIMIT, 10^5, particles, and
+                        'lattice' above or when they don't fit with 'poisson')
+                    walls (list of physim.Wall): Walls the particles must not overlap at the start.
+        '''
+        Particles.__init__(self)
         self.Rcm = r_0
-        self.N = N
         self.m = m
         self.energy = energy
         self.width = width
@@ -279,27 +680,46 @@ class Gas(Particles):
         energies = np.random.rand(N)
         energies = energy * energies/energies.sum()
         vel = np.sqrt(2*energies)
-        P = []
-        VerticalLim = height/2 - radius
-        HorizontalLim = width/2 - radius
-        for i in range(N):
-            theta = 2* np.pi * random()
-            v = [vel[i]* np.cos(theta), vel[i]* np.sin(theta)]
-            r = [randint(int(r_0[0] - HorizontalLim), int(r_0[0] + HorizontalLim)), 
-                 randint(int(r_0[1] - VerticalLim), int(r_0[1] + VerticalLim))]
-            color = (10*randint(0,10), 10*randint(10,25), 10*randint(20,25))
-            P.append(MassPoint(r, v, m, radius= radius, color = color))
-        
-        Particles.__init__(self, *P)
+        theta = 2* np.pi * np.random.rand(N)
+        v = vel[:, None] * np.column_stack((np.cos(theta), np.sin(theta)))
+
+        if placement == 'random':
+            VerticalLim = height/2 - radius
+            HorizontalLim = width/2 - radius
+            r = np.column_stack((np.random.randint(int(r_0[0] - HorizontalLim), int(r_0[0] + HorizontalLim) + 1, N), 
+                                 np.random.randint(int(r_0[1] - VerticalLim), int(r_0[1] + VerticalLim) + 1, N)))
+        else:
+            from . import PhyPlacement
+            r = None
+            if (placement is None) and (N <= PhyPlacement.POISSON_LIMIT):
+                try:
+                    r = PhyPlacement.poisson_disk(N, r_0, width, height, radius, walls = walls)
+                except ValueError:
+                    #Too dense for Poisson-disk sampling; the lattice fits more.
+                    pass
+            if r is None:
+                place = {'poisson': PhyPlacement.poisson_disk, 'lattice': PhyPlacement.lattice, None: PhyPlacement.lattice}[placement]
+                r = place(N, r_0, width, height, radius, walls = walls)
+        color = 10*np.column_stack((np.random.randint(0, 11, N), np.random.randint(10, 26, N), np.random.randint(20, 26, N)))
+
+        self._extend(r, v, m, radius = radius, color = color)
 
 
 
+#The integrators of Simulation, by name.
+INTEGRATORS = {
+    'euler': 'euler',
+    'semi-implicit': 'semi-implicit',
+    'verlet': 'verlet',
+    'leapfrog': 'verlet'
+}
+
 class Simulation: 
     '''
-    The simulation itself, with the pygame window and the main function.
+    The simulation itself, with the pygame window (unless it's headless) and the main function.
     '''
 
-    def __init__(self, P, particles = [], walls = [],size = (600, 600), FPS = 60, time_res = 1, backgound = (240,240,240), name = 'Simulation', TOP = True, BOTTOM = True, LEFT = True, RIGHT = True):
+    def __init__(self, P, particles = [], walls = [],size = (600, 600), FPS = 60, time_res = 1, backgound = (240,240,240), name = 'Simulation', TOP = True, BOTTOM = True, LEFT = True, RIGHT = True, headless = False, render_every = 1, realtime = True, forces = None, integrator = 'euler', substeps = 1, skin = None):
         '''
         We first save all variables needed for the simulation
             Inputs:
@@ -311,7 +731,25 @@ class Simulation:
                     background (tuple): A (RED, GREEN, BLUE) tuple with the background color with the usual RGB values.
                     name (string): The caption of the window.
                     TOP, BOTTOM, LEFT, RIGHT (boolean): If true, the corresponding window border will act as a wall.
+                    headless (boolean): If true, no window is opened and the simulation runs as fast as the CPU allows.
+                    render_every (int): With a window, draw only one frame every render_every time steps.
+                    realtime (boolean): With a window, wait for each frame (at most FPS frames per second). If false, 
+                        the physics runs as fast as it can and a frame is drawn only every 1/FPS seconds.
+                    forces (physim.Forces): Long-range forces (gravity, Coulomb) that set the 
+                        accelerations of the particles before every step. (None by default)
+                    integrator (str): How the particles are moved in each step: 'euler' (positions 
+                        and then velocities, as MassPoint.update), 'semi-implicit' (velocities and 
+                        then positions) or 'verlet' (velocity Verlet, also called 'leapfrog'). 
+                        ('euler' by default)
+                    substeps (int or str): The number of substeps of each time step, or 'adaptive' 
+                        to choose it every step so that no particle moves more than courant times 
+                        the smallest radius in a substep. (1 by default)
+                    skin (float): If given, the candidate pairs come from a physim.NeighbourList 
+                        with this skin, rebuilt only when a particle moved more than skin/2, instead 
+                        of hashing every step. (None by default)
         '''
+        if integrator not in INTEGRATORS:
+            raise ValueError('integrator must be one of ' + ', '.join(INTEGRATORS))
         self.P = P
         self.walls = walls
         self.size = size
@@ -319,12 +757,37 @@ class Simulation:
         self.time_res = time_res
         self.background = backgound
         self.name = name
+        self.headless = headless
+        self.render_every = render_every
+        self.realtime = realtime
+        self.forces = forces
+        self.integrator = INTEGRATORS[integrator]
+        self.substeps = substeps
+        #With adaptive substeps: the largest move in a substep, in smallest radii, and the
+        #largest number of substeps.
+        self.courant = 0.5
+        self.max_substeps = 64
+        #The forces used for the accelerations the particles have now (for Verlet).
+        self._accelerated = None
+        #The thread writing the last checkpoint, if it was written in the background.
+        self._saving = None
+        self.neighbours = None if skin is None else NeighbourList(P, skin)
+        #The window (a physim.src.PhyRender.Renderer); pygame is only imported when there is one.
+        self.renderer = None
 
-        self.WIN = pygame.display.set_mode(size)
-        pygame.display.set_caption(name)
-
-        pygame.font.init()
-        self.font = pygame.font.SysFont('consolas', 24)
+        #dt are the little time steps that we will take to update our simulation.
+        self.dt = time_res / FPS
+        #The simulated time and the number of steps taken so far.
+        self.t = 0
+        self.steps = 0
+        self.recorder = None
+        #Draws frames offscreen and writes them in the background (see export).
+        self.exporter = None
+        #An alternative engine (like physim.ParallelSimulation) that takes the time steps instead.
+        self.engine = None
+        #The time of each phase of the step, the counts of pairs and collisions, and the callbacks.
+        self.stats = Stats()
+        self.observables = None
 
         self.borders = []
         if TOP:
@@ -335,17 +798,44 @@ class Simulation:
             self.borders.append(Wall((0, size[1]/2), 10, size[1]))
         if RIGHT:
             self.borders.append(Wall((size[0], size[1]/2), 10, size[1]))
+
+        self.pack_walls()
+
+        if headless:
+            self.WIN = None
+            self.font = None
+        else:
+            from .PhyRender import Renderer
+            self.renderer = Renderer(self)
+            self.WIN = self.renderer.WIN
+            self.font = self.renderer.font
+
+    def pack_walls(self):
+        '''
+        Packs the walls and the borders in a physim.Walls. It must be called again if 
+        self.walls or self.borders are changed.
+        '''
+        self.W = Walls(*self.walls, *self.borders)
+        if self.renderer is not None:
+            self.renderer.invalidate()
+        if self.exporter is not None:
+            self.exporter.invalidate()
     
     def naive_particles_collisions (self):
         '''
         Handles all the collisions between particles.
+            Outputs:
+                    collisions (int): The number of collisions.
         '''
         #We make a list with len(self.particles) elements so we can iterate in each particle easily.
         N = self.P.N
         N_list = range(N)
+        #The views of the particles, made once.
+        points = list(self.P)
         #Now we're interested in checking only once the collision between particle i and 
         #particle j, we created a set for that purpose.
         checked = set()
+        collisions = 0
 
         #We don't want to check the collision of a particle with itself or check the collision of a 
         #particle twice.
@@ -353,79 +843,373 @@ class Simulation:
             for j in N_list:
                 if (i == j) | (j in checked):
                     continue
-                self.P[i].particle_collision(self.P[j])
+                collisions += points[i].particle_collision(points[j])
             checked.add(i)
+        return collisions
     
     def wall_collisons (self):
         '''
         Handles all the collisions between particles and walls.
+            Outputs:
+                    contacts (int): The number of particle-wall collisions.
         '''
-        for p in self.P:
-            for wall in self.walls:
-                p.wall_collision(wall)
-        
-        for p in self.P:
-            for wall in self.borders:
-                p.wall_collision(wall)
+        return self.W.collide(self.P)
 
 
-    def draw(self):
+    def draw(self, text = None):
         '''
         Draws each frame of the simulation.
+            Inputs:
+                    text (str or list of str): A text (or several lines) to show in the upper-right corner. (None by default)
+        Headless simulations have nothing to draw on, so it does nothing.
         '''
-        self.WIN.fill(self.background)
+        if self.renderer is None:
+            return
+        self.renderer.draw(text)
 
-        for wall in self.walls:
-            wall.draw(self.WIN, (35, 54, 77))
+    def accelerate(self):
+        '''
+        Sets the accelerations of the particles from self.forces, if there are any. Returns the 
+        seconds it took.
+        '''
+        if self.forces is None:
+            return 0.0
+        start = time.perf_counter()
+        self.forces.apply(self.P)
+        self._accelerated = self.forces
+        return time.perf_counter() - start
 
-        for wall in self.borders:
-            wall.draw(self.WIN, (13, 20, 28))
-        
-        for p in self.P:
-            p.draw(self.WIN)
-        
-        pygame.display.update()
+    def integrate(self, dt):
+        '''
+        Moves all the particles a time dt with self.integrator. Returns the seconds spent in 
+        the forces.
+        '''
+        P = self.P
+        if self.integrator == 'euler':
+            spent = self.accelerate()
+            P.update(dt)
+
+        elif self.integrator == 'semi-implicit':
+            spent = self.accelerate()
+            P.kick(dt)
+            P.drift(dt)
 
-    def run(self, ShowFPS = False, naive = False):
+        else:
+            #Kick-drift-kick: the accelerations at the start are the ones computed at the end 
+            #of the previous substep, so the forces are computed once per substep.
+            spent = 0.0
+            if (self.forces is not None) and (self._accelerated is not self.forces):
+                spent += self.accelerate()
+            P.kick(dt/2)
+            P.drift(dt)
+            spent += self.accelerate()
+            P.kick(dt/2)
+        return spent
+
+    def substeps_for(self, dt):
         '''
-        The main function in which we run the loop with the simulation.
-        Here we're going to integrate all the functions we defined 
-        before and update the whole system in real time, step by step.
+        The number of substeps for a time step dt: self.substeps, or if it's 'adaptive', enough 
+        for the fastest particle to move at most courant times the smallest radius in each one
+        (at most max_substeps).
         '''
-        #clock will help us to control the maximum speed of our simulation.
-        clock = pygame.time.Clock()
-        #dt are the little time steps that we will take to update our simulation.
-        dt = self.time_res / self.FPS
+        if self.substeps != 'adaptive':
+            return self.substeps
+        P = self.P
+        if not P.N:
+            return 1
+        vmax = np.sqrt(np.einsum('ij,ij->i', P.velocities, P.velocities).max())
+        smallest = P.radii.min()
+        if smallest <= 0:
+            return self.max_substeps
+        return int(min(max(np.ceil(vmax*dt / (self.courant*smallest)), 1), self.max_substeps))
 
-        #The Loop with the simulation.
-        while True:
-            #Here we define the maximum frame rate of our simulation.
-            clock.tick(self.FPS)
-
-            #The next loop helps us to end the program whenever the "X" 
-            #button on the up-right corner of the window is pressed.
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    break
-            
-            #Now we update the particles one by one.
-            for p in self.P:
-                p.update(dt)
+    def step(self, n = 1, naive = False):
+        '''
+        Advances the simulation n time steps, without drawing anything. Each one may be split 
+        in substeps (see substeps_for). Unless stats.enabled is False, the time of each phase 
+        and the number of pairs, collisions, wall contacts and substeps are recorded in self.stats.
+            Inputs:
+                    n (int): The number of time steps.
+                    naive (boolean): If true, use naive_particles_collisions instead of the spatial hash.
+        '''
+        if self.engine is not None:
+            #The engines notify the callbacks of self.stats themselves, at every step.
+            self.engine.step(n)
+            return
 
-            if naive:
-                self.naive_particles_collisions()
+        clock = time.perf_counter
+        stats = self.stats
+        for _ in range(n):
+            k = self.substeps_for(self.dt)
+            h = self.dt / k
+            times = [0.0]*5
+            counts = [0, 0, 0, k, 0]
+            for _ in range(k):
+                t0 = clock()
+                #Now we update all the particles at once.
+                spent = self.integrate(h)
+                t1 = clock()
 
-            else:
-                self.P.Hash()
-                self.P.Collision()
+                if naive:
+                    t2 = t1
+                    N = self.P.N
+                    pairs = N*(N - 1)//2
+                    rebuilds = 0
+                    collisions = self.naive_particles_collisions()
+
+                elif self.neighbours is not None:
+                    I, J, rebuilds = self.neighbours.pairs()
+                    t2 = clock()
+                    pairs = len(I)
+                    collisions = self.P.resolve(I, J)
+
+                else:
+                    self.P.Hash()
+                    t2 = clock()
+                    I, J = self.P.Pairs()
+                    pairs = len(I)
+                    rebuilds = 1
+                    collisions = self.P.resolve(I, J)
+                t3 = clock()
+
+                contacts = self.wall_collisons()
+                t4 = clock()
+
+                for i, seconds in enumerate((spent, t1 - t0 - spent, t2 - t1, t3 - t2, t4 - t3)):
+                    times[i] += seconds
+                for i, c in enumerate((pairs, collisions, contacts, 0, rebuilds)):
+                    counts[i] += c
+
+            self.t += self.dt
+            self.steps += 1
 
-            self.wall_collisons()
+            if stats.enabled:
+                stats.record(times, counts)
+            if stats.callbacks:
+                stats.notify(self)
+
+            if (self.recorder is not None) and (self.steps % self.recorder.every == 0):
+                self.recorder.write(self.P, self.steps, self.t)
+
+            if (self.exporter is not None) and (self.steps % self.exporter.every == 0):
+                t0 = clock()
+                self.exporter.write(self.P, self.steps, self.t)
+                if stats.enabled:
+                    stats.add('draw', clock() - t0)
+
+    def record(self, path, every = 1, chunk = 64):
+        '''
+        Starts streaming the positions and velocities of the particles to a trajectory file,
+        beginning with the current state. Read it back with physim.Trajectory.
+            Inputs:
+                    path (str): The file to write.
+                    every (int): The number of time steps between recorded frames. (1 by default)
+                    chunk (int): The number of frames kept in memory before writing them. (64 by default)
+        '''
+        self.stop_recording()
+        self.recorder = Recorder(path, self.P, self.dt, every = every, chunk = chunk)
+        self.recorder.write(self.P, self.steps, self.t)
+        return self.recorder
+
+    def stop_recording(self):
+        '''
+        Writes the remaining frames and closes the trajectory file.
+        '''
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def export(self, path, every = 1, fps = None, encoder = None, queue = 16, level = 1, text = None, threads = None):
+        '''
+        Starts exporting frames, beginning with the current state. They are drawn offscreen 
+        (with or without a window, and without waiting for FPS) and written by a background 
+        thread: a numbered sequence of PNG files, or a video made by an encoder that reads the raw 
+        RGBX frames from a pipe (ffmpeg by default).
+            Inputs:
+                    path (str): A pattern with the number of the frame, like 'frames/%05d.png', for 
+                        the PNG files, or the file of the video, like 'run.mp4'.
+                    every (int): The number of time steps between frames. (1 by default)
+                    fps (float): The frame rate of the video. (By default, the one that plays the 
+                        simulation in real time)
+                    encoder (list of str): The command of the encoder; {path}, {width}, {height} and 
+                        {fps} are filled in. (None by default: ffmpeg)
+                    queue (int): The largest number of frames waiting to be written; the simulation 
+                        only waits for the writer when it's this far behind. (16 by default)
+                    level (int): The zlib compression level of the PNG files, 0 to 9. (1 by default)
+                    text (function): Takes the simulation and returns the text of each frame. (None by default)
+                    threads (int): The number of threads writing PNG files. (By default, one per CPU, at most 4)
+        '''
+        self.stop_export()
+        from .PhyRender import FrameExporter
+        self.exporter = FrameExporter(self, path, every, fps, encoder, queue, level, text, threads)
+        self.exporter.write(self.P, self.steps, self.t)
+        return self.exporter
+
+    def stop_export(self):
+        '''
+        Writes the remaining frames and closes the files (or the encoder).
+        '''
+        if self.exporter is not None:
+            exporter, self.exporter = self.exporter, None
+            exporter.close()
+
+    def flush(self):
+        '''
+        Writes the frames of the recorder and of the exporter that are still in memory.
+        '''
+        if self.recorder is not None:
+            self.recorder.flush()
+        if self.exporter is not None:
+            self.exporter.flush()
+
+    def checkpoint(self, path, background = False):
+        '''
+        Saves the whole state of the simulation (particles, walls, borders, time, step count 
+        and the states of the random generators of numpy and Python) to a binary file that 
+        restore can memory-map back in.
+            Inputs:
+                    path (str): The file to write (replaced atomically).
+                    background (boolean): If true, only a copy of the state is taken now and the 
+                        file is written by a thread, so the simulation doesn't wait for the disk.
+            Outputs:
+                    thread (threading.Thread): The thread writing the file, or None.
+        '''
+        self.wait_checkpoint()
+        self._saving = PhyCheckpoint.save(self, path, background)
+        return self._saving
+
+    def wait_checkpoint(self):
+        '''
+        Waits until the checkpoint being written in the background (if any) is on disk.
+        '''
+        if self._saving is not None:
+            self._saving.join()
+            self._saving = None
+
+    def restore(self, path):
+        '''
+        Loads a checkpoint written by checkpoint: the particles, walls, borders, time, step 
+        count and random generators are replaced by the saved ones. The particle arrays are
+        memory-mapped from the file (copy-on-write), so restoring is instant. Active observables
+        measure the pressure again from the restored state.
+        '''
+        if self.engine is not None:
+            raise ValueError('close the engine before restoring a checkpoint')
+        self.wait_checkpoint()
+        PhyCheckpoint.restore(self, path)
+
+    def observe(self, every = 10, size = 1000, bins = 30, vmax = None):
+        '''
+        Starts measuring the energy, momentum, temperature, histograms and wall pressures every 
+        few time steps, beginning with the current state. See physim.Observables.
+            Inputs:
+                    every (int): The number of time steps between samples. (10 by default)
+                    size (int): The number of samples kept in the ring buffers. (1000 by default)
+                    bins (int): The number of bins of the histograms. (30 by default)
+                    vmax (float): The largest speed in the histograms.
+        '''
+        if self.observables is not None:
+            self.observables.close()
+        self.observables = Observables(self, every = every, size = size, bins = bins, vmax = vmax)
+        self.observables.sample()
+        self.stats.subscribe(self.observables.sample, every)
+        return self.observables
+
+    def replay(self, trajectory, start = 0, stop = None, every = 1):
+        '''
+        Shows a recorded trajectory: each frame is copied into the particles and drawn, 
+        without computing any physics.
+            Inputs:
+                    trajectory (physim.Trajectory or str): The trajectory (or the path of its file).
+                    start, stop, every (int): The frames to show, as in trajectory[start:stop:every].
+        '''
+        if not isinstance(trajectory, Trajectory):
+            trajectory = Trajectory(trajectory)
+        if trajectory.N != self.P.N:
+            raise ValueError('the trajectory has ' + str(trajectory.N) + ' particles, but the simulation has ' + str(self.P.N))
+
+        for frame in trajectory[start:stop:every]:
+            self.P.positions = frame['r']
+            self.P.velocities = frame['v']
+            self.t = float(frame['t'])
+            self.steps = int(frame['step'])
+            if self.headless:
+                continue
+
+            self.renderer.tick(self.FPS)
+            if self.renderer.closed():
+                return
             self.draw()
 
-            if ShowFPS:
-                img = self.font.render('FPS: ' + str(int(clock.get_fps())), True, (0,0,0))
-                self.WIN.blit(img, (self.size[0] - 100, 20))
-                pygame.display.update()
+    def done(self, start, steps, until):
+        '''
+        Checks if run should stop: after steps time steps since start, or when until is 
+        reached (a simulated time, or a function that takes the simulation and returns True 
+        to stop).
+        '''
+        if (steps is not None) and (self.steps - start >= steps):
+            return True
+        if until is None:
+            return False
+        if callable(until):
+            return until(self)
+        return self.t >= until
 
+    def run(self, ShowFPS = False, naive = False, steps = None, until = None, ShowStats = False):
+        '''
+        The main function in which we run the loop with the simulation.
+        Here we're going to integrate all the functions we defined 
+        before and update the whole system step by step. With a window, the frames
+        are shown in real time; headless, the simulation runs as fast as it can.
+            Inputs:
+                    ShowFPS (boolean): Show the frame rate in the window.
+                    naive (boolean): If true, use naive_particles_collisions instead of the spatial hash.
+                    steps (int): Stop after this number of time steps. (None by default: never stop)
+                    until (float or function): Stop when the simulated time reaches until, or 
+                        when until(simulation) returns True. (None by default)
+                    ShowStats (boolean): Show the milliseconds per step of each phase and the
+                        counts of pairs, collisions and wall contacts (from self.stats) instead of
+                        only the frame rate.
+        '''
+        start = self.steps
 
+        if self.headless:
+            while not self.done(start, steps, until):
+                self.step(naive = naive)
+            self.flush()
+            return
+
+        renderer = self.renderer
+        frame = 1 / self.FPS
+        last = time.perf_counter()
+
+        #The Loop with the simulation.
+        while not self.done(start, steps, until):
+            self.step(naive = naive)
+            if self.steps % self.render_every:
+                continue
+
+            if self.realtime:
+                #Here we define the maximum frame rate of our simulation.
+                renderer.tick(self.FPS)
+            else:
+                #The physics doesn't wait for the screen: we only draw when a frame is due.
+                now = time.perf_counter()
+                if now - last < frame:
+                    continue
+                last = now
+                renderer.tick()
+
+            #The program ends whenever the "X" button on the up-right corner of the window is pressed.
+            if renderer.closed():
+                self.flush()
+                return
+
+            t0 = time.perf_counter()
+            if ShowStats:
+                self.draw(self.stats.lines(renderer.fps()))
+            else:
+                self.draw('FPS: ' + str(int(renderer.fps())) if ShowFPS else None)
+            if self.stats.enabled:
+                self.stats.add('draw', time.perf_counter() - t0)
+        self.flush()
@@ -0,0 +1,189 @@
+import threading
+
+import numpy as np
+
+class Observables:
+    '''
+    Measures a Simulation while it runs. Every `every` time steps each observable is computed
+    from the particle arrays (vectorized, no MassPoint loops) and stored in a ring buffer of
+    the last size samples, together with the step and the time of the sample. The buffers can
+    be read at any moment, also from another thread while the simulation runs.
+
+    The built-in observables (with k_B = 1) are:
+        energy: The total energy: the kinetic energy, plus the potential energy of
+            Simulation.forces if there are any.
+        momentum: The total momentum, (px, py).
+        temperature: From the equipartition in two dimensions, E = N*T.
+        speed_histogram: The counts of the speeds in bins from 0 to vmax.
+        velocity_histogram: The counts of vx (first row) and vy (second row) in bins from -vmax to vmax.
+        pressure: The force per unit length on each wall since the previous sample, from the
+            momentum the bounces gave to it (Walls.impulse).
+    More can be added with add.
+    '''
+    def __init__(self, sim, every = 10, size = 1000, bins = 30, vmax = None):
+        '''
+            Inputs:
+                    sim (physim.Simulation): The simulation to measure.
+                Optional:
+                    every (int): The number of time steps between samples. (10 by default)
+                    size (int): The number of samples kept. (1000 by default)
+                    bins (int): The number of bins of the histograms. (30 by default)
+                    vmax (float): The largest speed in the histograms. (By default, 4 times the
+                        root mean square speed at the start)
+        '''
+        self.sim = sim
+        self.every = every
+        self.size = size
+        self.bins = bins
+        P = sim.P
+        if vmax is None:
+            vmax = 4*np.sqrt(np.mean(np.einsum('ij,ij->i', P.velocities, P.velocities))) if P.N else 1
+        self.vmax = vmax or 1
+
+        self.functions = {}
+        self.data = {}
+        self.steps = np.zeros(size, dtype = np.int64)
+        self.t = np.zeros(size)
+        #The number of samples taken so far; the newest one is at (count - 1) % size.
+        self.count = 0
+        self.lock = threading.Lock()
+
+        self.W = sim.W
+        self.impulse = self.W.impulse.copy()
+        self.t_last = sim.t
+
+        self.add('energy', self.energy)
+        self.add('momentum', self.momentum, (2,))
+        self.add('temperature', self.temperature)
+        self.add('speed_histogram', self.speed_histogram, (bins,), np.int64)
+        self.add('velocity_histogram', self.velocity_histogram, (2, bins), np.int64)
+        self.add('pressure', self.pressure, (self.W.N,))
+
+    def add(self, name, function, shape = (), dtype = float):
+        '''
+        Adds an observable.
+            Inputs:
+                    name (str): Its name.
+                    function (function): Takes the simulation and returns the value.
+                    shape (tuple of int): The shape of the value. (A number by default)
+                    dtype (np.dtype): The type of the value. (float by default)
+        '''
+        self.functions[name] = function
+        self.data[name] = np.zeros((self.size,) + tuple(shape), dtype = dtype)
+
+    def kinetic(self, sim):
+        P = sim.P
+        return 0.5 * np.einsum('i,ij,ij->', P.masses, P.velocities, P.velocities)
+
+    def energy(self, sim):
+        E = self.kinetic(sim)
+        if sim.forces is not None:
+            E += sim.forces.potential(sim.P)
+        return E
+
+    def momentum(self, sim):
+        P = sim.P
+        return P.masses @ P.velocities
+
+    def temperature(self, sim):
+        return self.kinetic(sim) / max(sim.P.N, 1)
+
+    def speed_histogram(self, sim):
+        speed = np.sqrt(np.einsum('ij,ij->i', sim.P.velocities, sim.P.velocities))
+        idx = (speed * (self.bins / self.vmax)).astype(np.int64)
+        return np.bincount(idx[idx < self.bins], minlength = self.bins)
+
+    def velocity_histogram(self, sim):
+        v = sim.P.velocities
+        idx = np.floor((v + self.vmax) * (self.bins / (2*self.vmax))).astype(np.int64)
+        inside = (0 <= idx) & (idx < self.bins)
+        flat = (idx + np.array([0, self.bins]))[inside]
+        return np.bincount(flat, minlength = 2*self.bins).reshape(2, self.bins)
+
+    def pressure(self, sim):
+        W = sim.W
+        if W is not self.W:
+            raise ValueError('the walls of the simulation changed; call Observables.rebind (or Simulation.observe again)')
+        elapsed = sim.t - self.t_last
+        force = (W.impulse - self.impulse) / elapsed if elapsed > 0 else np.zeros_like(W.impulse)
+        self.impulse = W.impulse.copy()
+        self.t_last = sim.t
+        #The x impulse pushes on the faces of length height, the y impulse on those of length width.
+        return force[:, 0] / (2*W.half[:, 1]) + force[:, 1] / (2*W.half[:, 0])
+
+    def rebind(self):
+        '''
+        Measures the pressure from the current walls of the simulation, starting now (after
+        Simulation.pack_walls or restore). If the number of walls changed, the pressure samples
+        taken so far are dropped.
+        '''
+        W = self.sim.W
+        if W.N != self.W.N:
+            self.add('pressure', self.pressure, (W.N,))
+        self.W = W
+        self.impulse = W.impulse.copy()
+        self.t_last = self.sim.t
+
+    def sample(self, sim = None):
+        '''
+        Computes all the observables now and stores them as a new sample.
+        '''
+        sim = sim or self.sim
+        values = {name: function(sim) for name, function in self.functions.items()}
+        k = self.count % self.size
+        with self.lock:
+            for name, value in values.items():
+                self.data[name][k] = value
+            self.steps[k] = sim.steps
+            self.t[k] = sim.t
+            self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def _order(self):
+        n = len(self)
+        return (np.arange(self.count - n, self.count)) % self.size
+
+    def __getitem__(self, name):
+        '''
+        A copy of the samples of an observable (or 'steps', or 't'), oldest first.
+        '''
+        with self.lock:
+            order = self._order()
+            if name == 'steps':
+                return self.steps[order]
+            if name == 't':
+                return self.t[order]
+            return self.data[name][order]
+
+    def latest(self, name):
+        '''
+        The last sample of an observable.
+        '''
+        with self.lock:
+            if not self.count:
+                raise IndexError('no samples yet')
+            return np.copy(self.data[name][(self.count - 1) % self.size])
+
+    def mean(self, name):
+        '''
+        The mean of the samples of an observable in the buffer.
+        '''
+        return self[name].mean(axis = 0)
+
+    def edges(self, name = 'speed_histogram'):
+        '''
+        The bins + 1 edges of the bins of a histogram.
+        '''
+        if name == 'speed_histogram':
+            return np.linspace(0, self.vmax, self.bins + 1)
+        return np.linspace(-self.vmax, self.vmax, self.bins + 1)
+
+    def close(self):
+        '''
+        Stops sampling (the buffers can still be read).
+        '''
+        self.sim.stats.unsubscribe(self.sample)
+        if self.sim.observables is self:
+            self.sim.observables = None
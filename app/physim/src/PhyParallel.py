@@ -0,0 +1,285 @@
+import os
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .PhyObjects import Particles, Wall, Walls, INTEGRATORS
+
+#The particle buffers the workers need, shared between all the processes.
+_SHARED = (('_r', (2,)), ('_v', (2,)), ('_a', (2,)), ('_m', ()), ('_radius', ()))
+
+_STEP = 0
+_STOP = 1
+
+#What each worker logs of every time step, for Simulation.stats.
+_LOG = ('integrate', 'hash', 'narrowphase', 'walls', 'pairs', 'collisions', 'wall_contacts', 'rescans', 'stamp')
+
+def _load(local, r, v, m, radius, groups, idx):
+    '''
+    Copies the particles idx of the shared arrays into the private Particles local,
+    reusing its buffers.
+    '''
+    local.N = 0
+    local._extend(r[idx], v[idx], m[idx], radius = radius[idx], group = groups[idx])
+
+def _worker(w, edges, cut, names, N, groups, walls, dt, barrier, sync, command, moved, log, window):
+    '''
+    The loop of worker w. Each time step has four phases separated by barriers:
+        1. Integrate the particles w*N/W to (w+1)*N/W.
+        2. The even strips resolve every collision of their own particles, also with the
+           ghosts: the particles of the neighbouring strips closer than cut to the border.
+        3. The odd strips resolve the collisions between their own particles (the ones with
+           the even strips were already solved in 2).
+        4. Collide the particles w*N/W to (w+1)*N/W with the walls.
+    The strips are at least 2*cut wide, so two even (or two odd) strips never touch the same
+    particle in the same phase.
+
+    Each worker only looks for the particles of its strip and ghosts among near, the ones that
+    were within cut more of the strip when it was last built. Like a Verlet list, near is
+    built again (by every worker at once) when some particle moved more than cut along x since
+    then; each worker measures that for its particles w*N/W to (w+1)*N/W, in moved[w].
+    '''
+    blocks = [shared_memory.SharedMemory(name = name) for name in names]
+    r, v, a, m, radius = [np.ndarray((N,) + shape, dtype = float, buffer = b.buf) for (_, shape), b in zip(_SHARED, blocks)]
+    W = len(edges) - 1
+    lo, hi = N*w//W, N*(w+1)//W
+    x0, x1 = edges[w], edges[w+1]
+    even = (w % 2 == 0)
+
+    moved = np.frombuffer(moved)
+    log = np.frombuffer(log).reshape(W, window, len(_LOG))[w]
+    clock = time.perf_counter
+
+    walls = Walls(*[Wall(c, width, height) for c, width, height in walls])
+    x = None
+    local = Particles()
+    band = Particles()
+    near = None
+    reference = r[lo:hi, 0].copy()
+
+    try:
+        while True:
+            sync.wait()
+            if command[0] == _STOP:
+                break
+
+            for step in range(command[1]):
+                row = log[step]
+                row[:] = 0
+                t0 = clock()
+                r[lo:hi] += dt * v[lo:hi]
+                v[lo:hi] += dt * a[lo:hi]
+                x = r[:, 0]
+                moved[w] = np.abs(x[lo:hi] - reference).max() if hi > lo else 0
+                row[0] = clock() - t0
+                barrier.wait()
+
+                t0 = clock()
+                if (near is None) or (moved.max() > cut):
+                    near = np.flatnonzero((x0 - 2*cut <= x) & (x < x1 + 2*cut))
+                    reference = x[lo:hi].copy()
+                    row[7] = 1
+                sel = near[(x0 - cut <= x[near]) & (x[near] < x1 + cut)]
+                own = (x0 <= x[sel]) & (x[sel] < x1)
+                row[1] = clock() - t0
+
+                for phase in (0, 1):
+                    if even == (phase == 0):
+                        t0 = clock()
+                        idx = sel if even else sel[own]
+                        _load(local, r, v, m, radius, groups, idx)
+                        local.Hash()
+                        t1 = clock()
+                        I, J = local.Pairs()
+                        if even:
+                            mine = own[I] | own[J]
+                            I, J = I[mine], J[mine]
+                        row[5] += local.resolve(I, J)
+                        row[4] += len(I)
+                        r[idx] = local.positions
+                        v[idx] = local.velocities
+                        row[1] += t1 - t0
+                        row[2] += clock() - t1
+                    barrier.wait()
+
+                t0 = clock()
+                _load(band, r, v, m, radius, groups, slice(lo, hi))
+                row[6] = walls.collide(band)
+                r[lo:hi] = band.positions
+                v[lo:hi] = band.velocities
+                row[3] = clock() - t0
+                barrier.wait()
+                row[8] = clock()
+
+            sync.wait()
+    except Exception:
+        #Don't leave the other processes waiting forever.
+        barrier.abort()
+        sync.abort()
+        raise
+    finally:
+        #The views must be gone before the blocks can be closed.
+        r = v = a = m = radius = x = reference = None
+        for b in blocks:
+            b.close()
+
+class ParallelSimulation:
+    '''
+    Runs the physics of a physim.Simulation on several processes. The box is split in
+    vertical strips, one per worker, and the particle arrays live in shared memory, so the
+    workers read the ghost particles near their borders straight from the arrays of their
+    neighbours instead of sending them to each other. Collisions follow exactly the same
+    rules as Particles.resolve and the walls those of Simulation.wall_collisons.
+    '''
+    def __init__(self, sim, workers = None):
+        '''
+            Inputs:
+                    sim (physim.Simulation): The simulation to run. While the workers are alive,
+                        its particles are kept in shared memory and no particles can be added.
+                        The workers move the particles like the 'euler' integrator, one substep
+                        per time step, with constant accelerations, so sim can't have forces.
+                Optional:
+                    workers (int): The number of processes (the number of CPUs by default).
+                        Each strip must be at least two particle diameters wide for each side,
+                        so there could be fewer workers in small boxes.
+        '''
+        if sim.forces is not None:
+            raise ValueError('the parallel engine has no long-range forces: sim.forces must be None')
+        if (INTEGRATORS[sim.integrator] != 'euler') or (sim.substeps != 1):
+            raise ValueError("the parallel engine only integrates with 'euler' and 1 substep")
+        self.sim = sim
+        P = sim.P
+        N = P.N
+        cut = P.cellSize()
+        width = sim.size[0]
+        workers = workers or os.cpu_count() or 1
+        workers = max(1, min(workers, int(width // (2*cut))))
+        self.workers = workers
+
+        edges = np.linspace(0, width, workers + 1)
+        edges[0], edges[-1] = -np.inf, np.inf
+
+        #We move the particle buffers to shared memory; P keeps working on them.
+        self.blocks = []
+        for name, shape in _SHARED:
+            block = shared_memory.SharedMemory(create = True, size = max(1, 8*N*int(np.prod(shape))))
+            array = np.ndarray((N,) + shape, dtype = float, buffer = block.buf)
+            array[:] = getattr(P, name)[:N]
+            setattr(P, name, array)
+            self.blocks.append(block)
+        P._q = P._q[:N].copy()
+        P._color = P._color[:N].copy()
+        P._group = P._group[:N].copy()
+
+        walls = [(tuple(wall.r), wall.width, wall.height) for wall in (*sim.walls, *sim.borders)]
+
+        ctx = mp.get_context()
+        self.barrier = ctx.Barrier(workers)
+        self.sync = ctx.Barrier(workers + 1)
+        self.command = ctx.RawArray('q', 2)
+        #The workers log every step of a batch, so a batch is at most window steps.
+        self.window = sim.stats.window
+        moved = ctx.RawArray('d', workers)
+        log = ctx.RawArray('d', workers * self.window * len(_LOG))
+        self.log = np.frombuffer(log).reshape(workers, self.window, len(_LOG))
+        #The number of times the workers looked for the particles near their strips in the whole box.
+        self.rescans = 0
+        self.processes = [ctx.Process(target = _worker, daemon = True,
+                                      args = (w, edges, cut, [b.name for b in self.blocks], N, P.groups.copy(), walls, sim.dt,
+                                              self.barrier, self.sync, self.command, moved, log, self.window))
+                          for w in range(workers)]
+        for p in self.processes:
+            p.start()
+        sim.engine = self
+
+    def _advance(self, n):
+        self.command[0] = _STEP
+        self.command[1] = n
+        self.sync.wait()
+        self.sync.wait()
+        self.sim.t += n * self.sim.dt
+        self.sim.steps += n
+
+        #A step takes as long as the slowest worker in each phase; the counts add up.
+        log = self.log[:, :n]
+        self.rescans += int(log[0, :, 7].sum())
+        stats = self.sim.stats
+        if stats.enabled:
+            times = np.zeros((n, 5))
+            times[:, 1:] = log[:, :, :4].max(0)
+            counts = np.ones((n, 5), dtype = np.int64)
+            counts[:, :3] = log[:, :, 4:7].sum(0)
+            for step in range(n):
+                stats.record(times[step], counts[step], log[:, step, 8].max())
+
+    def step(self, n = 1):
+        '''
+        Advances the simulation n time steps. The workers take up to window of them without
+        waiting for this process, unless the simulation is recording a trajectory, exporting
+        frames or has callbacks in sim.stats (the workers stop at every step where one is due).
+        Every step is recorded in sim.stats, with one substep and one rebuild of the hash.
+        '''
+        sim = self.sim
+        while n > 0:
+            outputs = [output for output in (sim.recorder, sim.exporter) if output is not None]
+            k = min(n, self.window)
+            for every in [output.every for output in outputs] + [every for _, every in sim.stats.callbacks]:
+                k = min(k, every - sim.steps % every)
+            self._advance(k)
+            n -= k
+            if sim.stats.callbacks:
+                sim.stats.notify(sim)
+            for output in outputs:
+                if sim.steps % output.every == 0:
+                    output.write(sim.P, sim.steps, sim.t)
+
+    def run(self, steps = None, until = None, batch = 100):
+        '''
+        Like Simulation.run without a window: stops after steps time steps, or when until
+        (a simulated time or a function of the simulation) is reached.
+            Inputs:
+                    batch (int): The largest number of steps taken between two checks of until.
+        '''
+        sim = self.sim
+        start = sim.steps
+        while not sim.done(start, steps, until):
+            n = batch
+            if steps is not None:
+                n = min(n, steps - (sim.steps - start))
+            if callable(until):
+                n = 1
+            elif until is not None:
+                n = min(n, max(1, int(np.ceil((until - sim.t) / sim.dt))))
+            sim.step(n)
+        sim.flush()
+
+    def close(self):
+        '''
+        Stops the workers and moves the particles back to private memory.
+        '''
+        if not self.processes:
+            return
+        self.command[0] = _STOP
+        try:
+            self.sync.wait()
+        except Exception:
+            pass
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        self.sim.engine = None
+
+        P = self.sim.P
+        for (name, _), block in zip(_SHARED, self.blocks):
+            setattr(P, name, getattr(P, name).copy())
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,170 @@
+'''
+Initial positions without overlaps. Both initializers place N disks of the given radius
+inside the box of center r_0 and size width x height, where none of them overlaps another
+one or any of the walls, and return an (N, 2) array for Particles.from_arrays (or
+Particles._extend). Everything is vectorized, so even millions of particles take a moment.
+'''
+import numpy as np
+
+from .PhyObjects import Particles, Walls
+
+#The largest number of particles that Gas places with poisson_disk by default (it takes about
+#0.2 s for 10^5 particles, but seconds for 10^6; lattice stays around 0.1 s for 10^6).
+POISSON_LIMIT = 10**5
+
+def _box(r_0, width, height, radius):
+    '''
+    The lowest and highest positions of the centers of disks of the given radius in the box.
+    '''
+    lo = np.array([r_0[0] - width/2, r_0[1] - height/2]) + radius
+    hi = np.array([r_0[0] + width/2, r_0[1] + height/2]) - radius
+    if np.any(hi < lo):
+        raise ValueError('the box is smaller than a particle')
+    return lo, hi
+
+def _walls(walls):
+    if isinstance(walls, Walls):
+        return walls if walls.N else None
+    return Walls(*walls) if len(walls) else None
+
+def _blocked(walls, r, radius):
+    '''
+    Which of the disks in r overlap a wall (with the rule of Walls.collide, as squares).
+    '''
+    if walls is None:
+        return np.zeros(len(r), dtype = bool)
+    P = Particles.from_arrays(r, radius = radius)
+    I, K = walls.Pairs(P)
+    I = I[walls.overlapping(P, I, K)]
+    blocked = np.zeros(len(r), dtype = bool)
+    blocked[I] = True
+    return blocked
+
+def lattice(N, r_0, width, height, radius, jitter = 0.5, walls = (), rng = np.random):
+    '''
+    A square lattice with N occupied sites, as coarse as the box allows, with every particle
+    moved a random amount inside its site. When there are more free sites than particles,
+    the occupied sites are chosen at random. It fits up to pi/4 of the box.
+        Inputs:
+                N (int): The number of particles.
+                r_0 (list): The center of the box.
+                width, height (float): The size of the box.
+                radius (float): The radius of the particles (the largest one, if they differ).
+            Optional:
+                jitter (float): How far a particle can move from its site, from 0 (a perfect
+                    lattice) to 1 (until it may touch its neighbours). (0.5 by default)
+                walls (list of physim.Wall or physim.Walls): Walls to keep away from.
+                rng (np.random.Generator): The random generator. (The global numpy one by default)
+        Outputs:
+                r (np.ndarray): The (N, 2) positions.
+    '''
+    lo, hi = _box(r_0, width, height, radius)
+    walls = _walls(walls)
+    if N == 0:
+        return np.zeros((0, 2))
+
+    #We start with about one site per particle and make the lattice finer until they all fit.
+    spacing = np.sqrt(np.prod(hi - lo + 2*radius) / N)
+    while True:
+        spacing = max(spacing, 2*radius)
+        shape = np.floor((hi - lo) / spacing).astype(np.int64) + 1
+        if np.prod(shape) >= N:
+            #Centered in the box.
+            start = lo + ((hi - lo) - (shape - 1)*spacing)/2
+            x = start[0] + spacing*np.arange(shape[0])
+            y = start[1] + spacing*np.arange(shape[1])
+            sites = np.stack(np.meshgrid(x, y, indexing = 'ij'), axis = -1).reshape(-1, 2)
+            shift = jitter * (spacing - 2*radius)/2
+            sites = sites[~_blocked(walls, sites, radius + shift)]
+            if len(sites) >= N:
+                break
+        if spacing == 2*radius:
+            raise ValueError('only ' + str(len(sites)) + ' of the ' + str(N) + ' particles fit in the box')
+        spacing *= 0.95
+
+    if len(sites) > N:
+        sites = sites[np.sort(rng.permutation(len(sites))[:N])]
+    #Two particles never get closer than spacing - 2*shift >= 2*radius, and clipping to the
+    #box only moves them back towards their sites.
+    r = sites + shift * (2*rng.random((N, 2)) - 1)
+    return np.clip(r, lo, hi)
+
+def poisson_disk(N, r_0, width, height, radius, walls = (), rng = np.random, rounds = 100):
+    '''
+    Random positions where no two particles overlap (Poisson-disk sampling). Candidates are
+    thrown in batches and kept if they don't touch the particles already placed; these are
+    kept in a grid with cells of 2*radius/sqrt(2), so each cell holds at most one particle and
+    only the 5x5 cells around a candidate need to be checked. It fits up to about half of the
+    box, and the particles look like a snapshot of a gas.
+        Inputs:
+                N, r_0, width, height, radius, walls, rng: As in lattice.
+            Optional:
+                rounds (int): The largest number of batches of candidates. (100 by default)
+        Outputs:
+                r (np.ndarray): The (N, 2) positions.
+    '''
+    lo, hi = _box(r_0, width, height, radius)
+    walls = _walls(walls)
+    diameter = 2*radius
+    cell = diameter / np.sqrt(2)
+    shape = np.floor((hi - lo) / cell).astype(np.int64) + 1
+    #The index of the particle in each cell (-1 if it's empty), with a border of 2 empty cells.
+    grid = np.full(shape + 4, -1, dtype = np.int64)
+    flat = grid.reshape(-1)
+    r = np.zeros((N, 2))
+    placed = 0
+    #The cells that could hold a particle closer than a diameter: the 5x5 block around a cell
+    #without its corners (two points there are at least cell*sqrt(2) = diameter apart), and
+    #only half of them for the pairs of candidates.
+    offsets = [dx*grid.shape[1] + dy for dx in range(-2, 3) for dy in range(-2, 3) if 0 < abs(dx) + abs(dy) < 4]
+    half = [k for k in offsets if k > 0]
+
+    for _ in range(rounds):
+        if placed == N:
+            break
+        M = (N - placed)*5//4 + 1024
+        c = lo + (hi - lo) * rng.random((M, 2))
+        cells = np.minimum(((c - lo) / cell).astype(np.int64), shape - 1) + 2
+        key = cells[:, 0] * grid.shape[1] + cells[:, 1]
+
+        #One candidate per free cell, sorted by cell so the grid is read in order.
+        _, first = np.unique(key, return_index = True)
+        first = first[flat[key[first]] < 0]
+        c, key = c[first], key[first]
+
+        #Away from the walls and the particles already placed...
+        ok = ~_blocked(walls, c, radius)
+        if placed:
+            for k in offsets:
+                j = flat[key + k]
+                near = np.flatnonzero(j >= 0)
+                d = r[j[near]] - c[near]
+                ok[near[np.einsum('ij,ij->i', d, d) < diameter*diameter]] = False
+            c, key = c[ok], key[ok]
+
+        #...and from the other candidates of this batch: of two that touch, the one with the
+        #lower (random) priority goes.
+        flat[key] = N + np.arange(len(c))
+        ok = np.ones(len(c), dtype = bool) if placed else ok
+        priority = rng.permutation(len(c))
+        for k in half:
+            j = flat[key + k] - N
+            i = np.flatnonzero(j >= 0)
+            j = j[i]
+            d = c[j] - c[i]
+            close = np.einsum('ij,ij->i', d, d) < diameter*diameter
+            i, j = i[close], j[close]
+            ok[np.where(priority[i] < priority[j], i, j)] = False
+        flat[key] = -1
+
+        new = np.flatnonzero(ok)
+        if len(new) > N - placed:
+            #A random subset, not the first cells.
+            new = np.sort(rng.permutation(new)[:N - placed])
+        r[placed:placed + len(new)] = c[new]
+        flat[key[new]] = placed + np.arange(len(new))
+        placed += len(new)
+
+    if placed < N:
+        raise ValueError('only ' + str(placed) + ' of the ' + str(N) + ' particles fit in the box; try lattice')
+    return r
@@ -0,0 +1,177 @@
+import numpy as np
+
+#Every trajectory file starts with this header, followed by the masses, radii and colors of
+#the particles and then by the frames, one after another.
+MAGIC = b'PHYSIMTR'
+VERSION = 1
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('every', '<u4'),
+    ('N', '<u8'),
+    ('dt', '<f8')
+])
+
+def frame_dtype(N):
+    '''
+    The binary layout of one frame of a trajectory with N particles.
+    '''
+    return np.dtype([
+        ('step', '<i8'),
+        ('t', '<f8'),
+        ('r', '<f8', (N, 2)),
+        ('v', '<f8', (N, 2))
+    ])
+
+def _offset(N):
+    '''
+    The position of the first frame in the file, aligned to 8 bytes.
+    '''
+    size = HEADER.itemsize + 16*N + 3*N
+    return size + (-size) % 8
+
+class Recorder:
+    '''
+    Streams the positions and velocities of a physim.Particles into an append-only binary
+    file. Frames are copied in bulk into a chunk buffer, and the buffer is written to the
+    file each time it fills up.
+    '''
+    def __init__(self, path, P, dt, every = 1, chunk = 64):
+        '''
+            Inputs:
+                    path (str): The file to write.
+                    P (physim.Particles): The particles to record.
+                    dt (float): The length of a time step.
+                Optional:
+                    every (int): The number of time steps between recorded frames. (1 by default)
+                    chunk (int): The number of frames kept in memory before writing them. (64 by default)
+        '''
+        self.path = path
+        self.N = P.N
+        self.dt = dt
+        self.every = every
+        self.frames = 0
+
+        self.buffer = np.zeros(chunk, dtype = frame_dtype(self.N))
+        self.filled = 0
+
+        header = np.array([(MAGIC, VERSION, every, self.N, dt)], dtype = HEADER)
+        self.file = open(path, 'wb')
+        self.file.write(header.tobytes())
+        self.file.write(np.ascontiguousarray(P.masses, dtype = '<f8').tobytes())
+        self.file.write(np.ascontiguousarray(P.radii, dtype = '<f8').tobytes())
+        self.file.write(np.ascontiguousarray(P.colors, dtype = np.uint8).tobytes())
+        self.file.write(bytes(_offset(self.N) - self.file.tell()))
+
+    def write(self, P, step, t):
+        '''
+        Adds the current state of the particles as a new frame.
+            Inputs:
+                    P (physim.Particles): The particles, with the same N as when the recorder was created.
+                    step (int): The number of the time step.
+                    t (float): The simulated time.
+        '''
+        if P.N != self.N:
+            raise ValueError('the number of particles changed while recording')
+        frame = self.buffer[self.filled]
+        frame['step'] = step
+        frame['t'] = t
+        frame['r'] = P.positions
+        frame['v'] = P.velocities
+        self.filled += 1
+        self.frames += 1
+        if self.filled == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the frames in the buffer to the file.
+        '''
+        if self.filled:
+            self.buffer[:self.filled].tofile(self.file)
+            self.filled = 0
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Trajectory:
+    '''
+    Reads a file written by a Recorder. The frames are memory-mapped, so any of them can be
+    read without loading the whole file.
+    '''
+    def __init__(self, path):
+        '''
+            Inputs:
+                    path (str): The file to read.
+        '''
+        self.path = path
+        header = np.fromfile(path, dtype = HEADER, count = 1)
+        if (len(header) == 0) or (header['magic'][0] != MAGIC):
+            raise ValueError(path + ' is not a physim trajectory')
+        if header['version'][0] != VERSION:
+            raise ValueError('unsupported trajectory version ' + str(header['version'][0]))
+
+        N = int(header['N'][0])
+        self.N = N
+        self.dt = float(header['dt'][0])
+        self.every = int(header['every'][0])
+
+        with open(path, 'rb') as f:
+            f.seek(HEADER.itemsize)
+            self.masses = np.frombuffer(f.read(8*N), dtype = '<f8')
+            self.radii = np.frombuffer(f.read(8*N), dtype = '<f8')
+            self.colors = np.frombuffer(f.read(3*N), dtype = np.uint8).reshape(N, 3)
+            f.seek(0, 2)
+            size = f.tell()
+
+        #A run that crashed may have left half a frame at the end; we ignore it.
+        dtype = frame_dtype(N)
+        count = (size - _offset(N)) // dtype.itemsize
+        if count:
+            self.frames = np.memmap(path, dtype = dtype, mode = 'r', offset = _offset(N), shape = (count,))
+        else:
+            self.frames = np.zeros(0, dtype = dtype)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, k):
+        return self.frames[k]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    @property
+    def steps(self):
+        return self.frames['step']
+
+    @property
+    def t(self):
+        return self.frames['t']
+
+    def positions(self, k):
+        return self.frames[k]['r']
+
+    def velocities(self, k):
+        return self.frames[k]['v']
+
+    def particles(self, k = 0):
+        '''
+        Builds a physim.Particles with the recorded particles in the frame k.
+        '''
+        from .PhyObjects import Particles
+        P = Particles()
+        if len(self.frames):
+            P._extend(self.frames[k]['r'], self.frames[k]['v'], self.masses, radius = self.radii, color = self.colors)
+        else:
+            P._extend(np.zeros((self.N, 2)), 0, self.masses, radius = self.radii, color = self.colors)
+        return P
@@ -0,0 +1,201 @@
+'''
+Everything that needs pygame. The physics in PhyObjects never imports this module; it's
+loaded the first time something is drawn or a Simulation with a window is created.
+'''
+import numpy as np
+import pygame
+
+from .PhyExport import FrameWriter
+
+def _tobytes(surface):
+    '''
+    The pixels of surface as RGBX bytes (pygame.image.tostring, without RGBX, before pygame 2.1.3).
+    '''
+    if hasattr(pygame.image, 'tobytes'):
+        return pygame.image.tobytes(surface, 'RGBX')
+    return pygame.image.tostring(surface, 'RGBA')
+
+def draw_point(win, p):
+    '''
+    Draws the MassPoint p as a circle on the surface win.
+    '''
+    pygame.draw.circle(win, p.color, (p.r[0], p.r[1]), p.radius)
+
+def draw_wall(win, wall, color):
+    '''
+    Draws the Wall wall as a rectangle of the given color on the surface win.
+    '''
+    rectangle = pygame.Rect(wall.r[0] - wall.width/2, wall.r[1] - wall.height/2, wall.width, wall.height)
+    pygame.draw.rect(win, color, rectangle)
+
+class Renderer:
+    '''
+    The pygame window of a Simulation, with the caches used to draw it fast: the background
+    with the walls already drawn, and one circle sprite for each radius and color. Offscreen,
+    the frames are drawn to a Surface in memory instead, without any display.
+    '''
+    def __init__(self, sim, offscreen = False):
+        '''
+            Inputs:
+                    sim (physim.Simulation): The simulation to show.
+                    offscreen (boolean): Draw to a Surface in memory instead of a window. (False by default)
+        '''
+        self.sim = sim
+        self.offscreen = offscreen
+        if offscreen:
+            self.WIN = pygame.Surface(sim.size)
+        else:
+            self.WIN = pygame.display.set_mode(sim.size)
+            pygame.display.set_caption(sim.name)
+
+        pygame.font.init()
+        self.font = pygame.font.SysFont('consolas', 24)
+
+        #clock will help us to control the maximum speed of our simulation.
+        self.clock = pygame.time.Clock()
+
+        self._backdrop = None
+        self._sprites = {}
+        self._style = None
+
+    def invalidate(self):
+        '''
+        Forgets the background, so it's drawn again with the current walls.
+        '''
+        self._backdrop = None
+
+    def backdrop(self):
+        '''
+        The background with the walls and borders already drawn on it. Walls don't move, so
+        it's drawn only once (and again after invalidate).
+        '''
+        if self._backdrop is None:
+            sim = self.sim
+            surface = pygame.Surface(sim.size)
+            surface.fill(sim.background)
+
+            for wall in sim.walls:
+                draw_wall(surface, wall, (35, 54, 77))
+
+            for wall in sim.borders:
+                draw_wall(surface, wall, (13, 20, 28))
+            self._backdrop = surface.convert() if pygame.display.get_surface() else surface
+        return self._backdrop
+
+    def sprite(self, radius, color):
+        '''
+        A small transparent surface with a circle of the given radius and color, drawn once
+        and kept for every particle that looks the same.
+        '''
+        key = (radius, color)
+        sprite = self._sprites.get(key)
+        if sprite is None:
+            c = int(np.ceil(radius))
+            sprite = pygame.Surface((2*c + 1, 2*c + 1), pygame.SRCALPHA)
+            pygame.draw.circle(sprite, color, (c, c), radius)
+            self._sprites[key] = sprite
+        return sprite
+
+    def _styles(self):
+        '''
+        The sprite of every particle and the offset from its center to the corner of the sprite.
+        They are only looked up again when the radii or the colors of the particles change.
+        '''
+        P = self.sim.P
+        if (self._style is None) or not (np.array_equal(self._style[0], P.radii) and np.array_equal(self._style[1], P.colors)):
+            styles, which = np.unique(np.column_stack((P.radii, P.colors)), axis = 0, return_inverse = True)
+            sprites = [self.sprite(float(radius), (int(r), int(g), int(b))) for radius, r, g, b in styles]
+            offsets = np.ceil(styles[:, 0])[which.ravel()]
+            self._style = (P.radii.copy(), P.colors.copy(), [sprites[k] for k in which.ravel()], offsets[:, None])
+        return self._style[2], self._style[3]
+
+    def draw(self, text = None):
+        '''
+        Draws a frame: the cached background, then all the particles with a single
+        Surface.blits call, and the display is updated once.
+            Inputs:
+                    text (str or list of str): A text (or several lines) to show in the upper-right corner. (None by default)
+        '''
+        P = self.sim.P
+        self.WIN.blit(self.backdrop(), (0, 0))
+
+        if P.N:
+            sprites, offsets = self._styles()
+            corners = np.rint(P.positions - offsets).astype(int).tolist()
+            self.WIN.blits(zip(sprites, corners), doreturn = False)
+
+        if text:
+            lines = [text] if isinstance(text, str) else text
+            imgs = [self.font.render(line, True, (0,0,0)) for line in lines]
+            #Long lines are moved to the left so they fit in the window.
+            x = min(self.sim.size[0] - 100, self.sim.size[0] - 10 - max(img.get_width() for img in imgs))
+            self.WIN.blits([(img, (x, 20 + k*self.font.get_linesize())) for k, img in enumerate(imgs)], doreturn = False)
+
+        if not self.offscreen:
+            pygame.display.update()
+
+    def frame(self):
+        '''
+        The last frame drawn, as the raw RGBX bytes of its rows from top to bottom.
+        '''
+        return _tobytes(self.WIN)
+
+    def tick(self, FPS = 0):
+        '''
+        Waits as much as needed to show at most FPS frames per second (0 means don't wait).
+        '''
+        self.clock.tick(FPS)
+
+    def fps(self):
+        return self.clock.get_fps()
+
+    def closed(self):
+        '''
+        Handles the window events; returns True (and closes pygame) when the "X"
+        button on the up-right corner of the window is pressed.
+        '''
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                return True
+        return False
+
+class FrameExporter:
+    '''
+    Draws the frames of a Simulation offscreen, as fast as the physics goes, and hands them to
+    a physim FrameWriter, which writes them in the background. It's written every few time
+    steps like a Recorder.
+    '''
+    def __init__(self, sim, path, every = 1, fps = None, encoder = None, queue = 16, level = 1, text = None, threads = None):
+        '''
+            Inputs:
+                    sim (physim.Simulation): The simulation to draw.
+                    path, encoder, queue, level, threads: As in FrameWriter.
+                Optional:
+                    every (int): The number of time steps between frames. (1 by default)
+                    fps (float): The frame rate of the video. (By default, the one that plays the
+                        simulation in real time, 1/(every*dt))
+                    text (function): Takes the simulation and returns the text to show in the
+                        upper-right corner of each frame. (None by default)
+        '''
+        self.sim = sim
+        self.every = every
+        self.text = text
+        self.renderer = Renderer(sim, offscreen = True)
+        self.writer = FrameWriter(path, sim.size, fps or 1/(every*sim.dt), encoder, queue, level, threads)
+
+    def write(self, P, step, t):
+        '''
+        Draws the current state of the simulation and adds it as a new frame.
+        '''
+        self.renderer.draw(self.text(self.sim) if self.text else None)
+        self.writer.put(self.renderer.frame())
+
+    def invalidate(self):
+        self.renderer.invalidate()
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
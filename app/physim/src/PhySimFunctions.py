@@ -0,0 +1,54 @@
+import numpy as np
+
+def elastic_collision(v1, v2, m1, m2):
+    '''
+    The velocities after an elastic collision: the energy and momentum right before the 
+    collision are the same as the energy and momentum after the hit.
+        Inputs:
+                v1, v2 (np.ndarray): The velocities of both particles (one or many rows).
+                m1, m2 (float or np.ndarray): Their masses, with shapes that broadcast with the velocities.
+        Outputs:
+                v1, v2 (np.ndarray): The new velocities.
+    '''
+    c1 = (m1 - m2)/(m1 + m2)
+    c2 = 2*m1 / (m1 + m2)
+    v_r = v1 - v2
+    return c1*v_r + v2, c2*v_r + v2
+
+def expand_ranges(starts, counts):
+    '''
+    Expands a set of index ranges into one flat array, without any Python loop.
+        Inputs:
+                starts (np.ndarray of int): The first index of each range.
+                counts (np.ndarray of int): The length of each range.
+        Outputs:
+                owner (np.ndarray of int): For every expanded index, the number of the range it came from.
+                index (np.ndarray of int): The expanded indices, range after range.
+    '''
+    counts = np.asarray(counts, dtype = np.int64)
+    total = counts.sum()
+    owner = np.repeat(np.arange(len(counts)), counts)
+    #Inside each range we count 0, 1, 2, ... and shift the count by the start of the range.
+    offsets = np.cumsum(counts) - counts
+    index = np.arange(total) - offsets[owner] + np.asarray(starts, dtype = np.int64)[owner]
+    return owner, index
+
+def disjoint_pairs(I, J, N):
+    '''
+    Picks a set of pairs in which no particle appears twice, so that all of them can be
+    resolved at the same time with fancy indexing. A pair is taken when it's the first pair
+    (in the given order) of both of its particles, so the first pair is always taken.
+        Inputs:
+                I, J (np.ndarray of int): The indices of the particles in each pair. J can be None 
+                    when only the particles in I have to be different (e.g. particle-wall pairs).
+                N (int): The number of particles.
+        Outputs:
+                keep (np.ndarray of bool): True for the pairs that can be resolved together.
+    '''
+    k = np.arange(len(I))
+    first = np.full(N, len(I))
+    np.minimum.at(first, I, k)
+    if J is None:
+        return first[I] == k
+    np.minimum.at(first, J, k)
+    return (first[I] == k) & (first[J] == k)
@@ -0,0 +1,151 @@
+import time
+
+import numpy as np
+
+#The phases of a time step, in the order they happen, and what is counted in each step.
+PHASES = ('forces', 'integrate', 'hash', 'narrowphase', 'walls', 'draw')
+COUNTERS = ('pairs', 'collisions', 'wall_contacts', 'substeps', 'rebuilds')
+
+class Stats:
+    '''
+    The instrumentation of a physim.Simulation: the seconds spent in each phase of the last
+    window time steps, the number of candidate pairs, collisions, wall contacts, substeps and
+    rebuilds of the spatial hash (or of the neighbour list) of each step, and the functions to
+    call every few steps. The rows are kept in ring buffers, so recording a step is just a
+    couple of array writes.
+
+    The draw phase is added to the step after which the frame was drawn, so its mean is the
+    cost of drawing per time step.
+    '''
+    def __init__(self, window = 120):
+        '''
+            Inputs:
+                    window (int): The number of time steps in the rolling statistics. (120 by default)
+        '''
+        self.enabled = True
+        self.callbacks = []
+        #The step of the simulation the last time notify was called.
+        self.seen = None
+        self.reset(window)
+
+    def reset(self, window = None):
+        '''
+        Forgets everything recorded so far (the callbacks are kept).
+        '''
+        if window is not None:
+            self.window = window
+        self.times = np.zeros((self.window, len(PHASES)))
+        self.counts = np.zeros((self.window, len(COUNTERS)), dtype = np.int64)
+        #The wall-clock time at which each step ended.
+        self.stamps = np.zeros(self.window)
+        self.steps = 0
+        self.totals = dict.fromkeys(PHASES + COUNTERS, 0)
+
+    def __len__(self):
+        return min(self.steps, self.window)
+
+    def record(self, times, counts, stamp = None):
+        '''
+        Adds a time step.
+            Inputs:
+                    times (tuple of float): The seconds spent in each of PHASES but draw.
+                    counts (tuple of int): The value of each of COUNTERS.
+                Optional:
+                    stamp (float): The time.perf_counter() at which the step ended, if it was
+                        taken earlier (by another process). (Now by default)
+        '''
+        k = self.steps % self.window
+        self.times[k, :-1] = times
+        self.times[k, -1] = 0
+        self.counts[k] = counts
+        self.stamps[k] = time.perf_counter() if stamp is None else stamp
+        self.steps += 1
+        for name, value in zip(PHASES, times):
+            self.totals[name] += value
+        for name, value in zip(COUNTERS, counts):
+            self.totals[name] += value
+
+    def add(self, phase, seconds):
+        '''
+        Adds seconds to the given phase of the last time step (used for draw).
+        '''
+        if self.steps:
+            self.times[(self.steps - 1) % self.window, PHASES.index(phase)] += seconds
+        self.totals[phase] += seconds
+
+    def _rows(self, array):
+        return array[:len(self)]
+
+    def mean(self, name):
+        '''
+        The mean over the window of a phase (in seconds per step) or of a counter (per step).
+        '''
+        if not len(self):
+            return 0.0
+        if name in PHASES:
+            return float(self._rows(self.times)[:, PHASES.index(name)].mean())
+        return float(self._rows(self.counts)[:, COUNTERS.index(name)].mean())
+
+    def last(self, name):
+        '''
+        The value of a phase or a counter in the last time step.
+        '''
+        if not self.steps:
+            return 0
+        k = (self.steps - 1) % self.window
+        if name in PHASES:
+            return float(self.times[k, PHASES.index(name)])
+        return int(self.counts[k, COUNTERS.index(name)])
+
+    def steps_per_sec(self):
+        '''
+        The wall-clock rate of the time steps in the window (everything included).
+        '''
+        n = len(self)
+        if n < 2:
+            return 0.0
+        stamps = self._rows(self.stamps)
+        first = stamps[self.steps % self.window] if self.steps > self.window else stamps[0]
+        elapsed = stamps[(self.steps - 1) % self.window] - first
+        return float((n - 1) / elapsed) if elapsed > 0 else 0.0
+
+    def summary(self):
+        '''
+        The rolling statistics as a dictionary: the mean of every phase and counter, and the
+        steps per second.
+        '''
+        summary = {name: self.mean(name) for name in PHASES + COUNTERS}
+        summary['steps_per_sec'] = self.steps_per_sec()
+        return summary
+
+    def lines(self, fps = None):
+        '''
+        The text of the overlay: the frame rate, the milliseconds per step of each phase
+        and the counters.
+        '''
+        lines = [] if fps is None else ['FPS: ' + str(int(fps))]
+        lines += ['{:<13} {:6.2f} ms'.format(name, 1000*self.mean(name)) for name in PHASES]
+        #The rebuilds per step are a fraction.
+        lines += ['{:<13} {:9.{}f}'.format(name, self.mean(name), 2 if name == 'rebuilds' else 0) for name in COUNTERS]
+        return lines
+
+    def subscribe(self, callback, every = 1):
+        '''
+        Calls callback(simulation) every `every` time steps.
+        '''
+        self.callbacks.append((callback, every))
+
+    def unsubscribe(self, callback):
+        self.callbacks = [c for c in self.callbacks if c[0] != callback]
+
+    def notify(self, sim):
+        '''
+        Calls the callbacks that are due at the current step of the simulation.
+        '''
+        #Engines may take several steps at once; a callback is due if a multiple of its
+        #period was passed since the last call.
+        before = sim.steps - 1 if self.seen is None else self.seen
+        self.seen = sim.steps
+        for callback, every in self.callbacks:
+            if sim.steps // every > before // every:
+                callback(sim)
@@ -1,13 +1,12 @@
-from physim import Simulation, Particles, MassPoint
+import numpy as np
+from physim import Simulation, Particles
 
 SCALE = 10
 
 v = [10*SCALE, 5*SCALE]
-Block = Particles(*[])
-for i in range(20):
-    for j in range(5):
-        p = MassPoint([SCALE*(2*i+1), 3*SCALE*(j+1)], v, 1, radius = 0.5*SCALE)
-        Block.add(p)
+i, j = np.meshgrid(np.arange(20), np.arange(5), indexing = 'ij')
+r = np.column_stack((SCALE*(2*i.ravel()+1), 3*SCALE*(j.ravel()+1)))
+Block = Particles.from_arrays(r, v, 1, radius = 0.5*SCALE)
 
 SIM = Simulation(Block, name = 'Block')
-SIM.run()
\ No newline at end of file
+SIM.run()
@@ -1,4 +1,5 @@
-from physim import Simulation, Particles, MassPoint
+import numpy as np
+from physim import Simulation, Particles
 
 SCALE = 30
 WIDTH = 400
@@ -8,15 +9,12 @@ w = int(WIDTH/SCALE)
 h = int(HEIGHT/SCALE)
 
 v = [10*SCALE, 0]
-Medium = Particles(*[])
-for i in range(1, w):
-    for j in range(h):
-        p = MassPoint([SCALE*(2*i+1), 3*SCALE*(j+1)], [0,0], 1, radius = 0.5*SCALE)
-        Medium.add(p)
-
-for j in range(h):
-    p = MassPoint([SCALE, 3*SCALE*(j+1)], v, 1, radius = 0.5*SCALE)
-    Medium.add(p)
+#The medium at rest, and the column on the left that hits it.
+i, j = np.meshgrid(np.arange(1, w), np.arange(h), indexing = 'ij')
+i = np.concatenate((i.ravel(), np.zeros(h, dtype = int)))
+j = np.concatenate((j.ravel(), np.arange(h)))
+r = np.column_stack((SCALE*(2*i+1), 3*SCALE*(j+1)))
+Medium = Particles.from_arrays(r, np.where((i == 0)[:, None], v, [0,0]), 1, radius = 0.5*SCALE)
 
 SIM = Simulation(Medium, size = (WIDTH, HEIGHT), name = 'Wave')
-SIM.run(ShowFPS = True)
\ No newline at end of file
+SIM.run(ShowFPS = True)